@@ -1,34 +1,27 @@
 from __future__ import unicode_literals, print_function
+import io
 import os
 import re
 import sys
-import stat
-import zlib
 import time
 import types
-import base64
-import shutil
-import pathlib
-import inspect
+import errno
 import logging
+import selectors
+import threading
 import functools
+import itertools
 import posixpath
 from subprocess import Popen
 from subprocess import PIPE
 from subprocess import STDOUT
+from subprocess import DEVNULL
 from copy import deepcopy
-from ConfigObject import ConfigObject
+from collections import deque
 from contextlib import contextmanager
 
-try:
-    from fabric import api as fabric
-except ImportError:
-    HAS_FABRIC = False
-else:  # pragma: no cover
-    if 'nosetests' in sys.argv[0]:
-        HAS_FABRIC = False
-    else:
-        HAS_FABRIC = True
+# heavy modules (fabric, ConfigObject, docopt, inspect, ...) are imported on
+# first use to keep the startup of scripts fast
 
 __all__ = [
     'logopts', 'info', 'debug', 'error', 'exc',  # logging
@@ -103,10 +96,19 @@ class Log(object):
         return wrapper
 
 
+_sudo_checked = set()
+
+
 def check_sudo():
+    """Check that sudo is usable. The result is cached for the process as long
+    as the sudo binary does not change"""
     sudo = aliases.get('sudo')
     if not os.path.isfile(sudo):
         raise OSError('sudo is not installed')
+    st = os.stat(sudo)
+    key = (sudo, st.st_ino, st.st_size, st.st_mtime_ns)
+    if key in _sudo_checked:
+        return
     args = [sudo, '-s', 'whoami']
     kwargs = dict(stdout=PIPE, stderr=STDOUT)
     log.debug('Popen(%r, **%r)', args, kwargs)
@@ -115,6 +117,494 @@ def check_sudo():
     whoami = whoami.stdout.read().strip()
     if whoami != b'root':
         raise OSError('Not able to run sudo.')
+    _sudo_checked.add(key)
+
+
+class ForkServer(object):
+    """A small python process started once. It spawns commands on request so
+    the cost of a spawn does not depend on the memory used by the current
+    process. Use ``launcher='forkserver'`` to use it in a pipe. The server of
+    the current process is returned by :meth:`get`"""
+
+    error = 'Not able to start the fork server.'
+    instance = None
+    popen_kwargs = dict(stdin=DEVNULL, close_fds=True)
+
+    def __init__(self):
+        self.sock = None
+        self.process = None
+        # the lock protects the socket while sending. messages are read by a
+        # thread and waiters are notified with the condition
+        self.lock = threading.RLock()
+        self.cond = threading.Condition(threading.Lock())
+        self.exited = False
+        self.returncodes = {}
+        self.replies = {}
+        self.index = 0
+        self.pid = os.getpid()
+
+    @classmethod
+    def get(cls):
+        """Return the running server. Start it if needed"""
+        server = cls.instance
+        if server is None or server.pid != os.getpid():
+            # do not share the socket of the parent after a fork
+            server = cls.instance = cls().start()
+        return server
+
+    @classmethod
+    def supports(cls, kwargs):
+        """True if a process can be spawned with those Popen arguments"""
+        return not set(kwargs) - set((
+            'stdin', 'stdout', 'stderr', 'env', 'cwd', 'shell', 'executable',
+            'start_new_session', 'close_fds'))
+
+    def helper_args(self, path):
+        return [sys.executable, '-c', FORK_SERVER, path]
+
+    def environ(self, kwargs):
+        """Return the environment of a command (None to use the environment
+        of the helper) and the variables to add to it"""
+        return dict(kwargs.get('env') or env), {}
+
+    def start(self, timeout=60):
+        import socket
+        import tempfile
+        tmp = tempfile.mkdtemp(prefix='chut-helper-')
+        path = os.path.join(tmp, 'socket')
+        args = self.helper_args(path)
+        log.debug('Popen(%r)', args)
+        self.process = Popen(args, env=env, **self.popen_kwargs)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        end = time.time() + timeout
+        while True:
+            try:
+                sock.connect(path)
+                break
+            except OSError:
+                if self.process.poll() is None and time.time() < end:
+                    time.sleep(.01)
+                    continue
+                sock.close()
+                if self.process.poll() is None:
+                    self.process.kill()
+                self.close()
+                for func, arg in ((os.unlink, path), (os.rmdir, tmp)):
+                    try:
+                        func(arg)
+                    except OSError:
+                        pass
+                raise OSError(self.error)
+        self.sock = sock
+        self.exited = False
+        reader = threading.Thread(target=self.read, args=(sock,))
+        reader.daemon = True
+        reader.start()
+        return self
+
+    def close(self):
+        import socket
+        if self.sock is not None:
+            try:
+                # wake up the reader
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None
+        if self.process is not None:
+            self.process.wait()
+            self.process = None
+
+    def send(self, message, fds=()):
+        import array
+        import socket
+        import json
+        data = json.dumps(message).encode('utf8') + b'\n'
+        ancdata = []
+        if fds:
+            ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                        array.array('i', fds))]
+        with self.lock:
+            self.sock.sendmsg([data], ancdata)
+
+    def read(self, sock):
+        """Read the messages of the helper until it exits. Run in a thread"""
+        import json
+        buffer = b''
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                with self.cond:
+                    self.exited = True
+                    self.cond.notify_all()
+                return
+            buffer += data
+            lines = buffer.split(b'\n')
+            buffer = lines.pop()
+            with self.cond:
+                for line in lines:
+                    message = json.loads(line.decode('utf8'))
+                    if 'returncode' in message:
+                        self.returncodes[message['id']] = message['returncode']
+                    else:
+                        self.replies[message['id']] = message
+                self.cond.notify_all()
+
+    def receive(self, messages, index):
+        """Wait for the message of a command in ``messages`` (the replies or
+        the returncodes) and return it"""
+        with self.cond:
+            while index not in messages:
+                if self.exited:
+                    raise OSError('fork server exited')
+                self.cond.wait()
+            return messages.pop(index)
+
+    def popen(self, args, kwargs):
+        """Spawn a command. Return a Popen like object"""
+        if kwargs.get('shell'):
+            args = ['/bin/sh', '-c', args]
+        fds = []
+        close = []
+        files = {}
+        for name, default in (('stdin', 0), ('stdout', 1), ('stderr', 2)):
+            value = kwargs.get(name)
+            if value is None:
+                fd = default
+            elif value == PIPE:
+                r, w = os.pipe()
+                if name == 'stdin':
+                    fd = r
+                    files[name] = os.fdopen(w, 'wb')
+                else:
+                    fd = w
+                    files[name] = os.fdopen(r, 'rb')
+                close.append(fd)
+            elif value == DEVNULL:
+                fd = os.open(os.devnull, os.O_RDWR)
+                close.append(fd)
+            elif value == STDOUT:
+                fd = fds[-1]
+            elif isinstance(value, int):
+                fd = value
+            else:
+                fd = value.fileno()
+            fds.append(fd)
+        environ, env_update = self.environ(kwargs)
+        with self.lock:
+            self.index += 1
+            index = self.index
+            try:
+                self.send(dict(id=index, args=args,
+                               executable=kwargs.get('executable'),
+                               start_new_session=kwargs.get(
+                                   'start_new_session', False),
+                               env=environ, env_update=env_update,
+                               cwd=kwargs.get('cwd') or os.getcwd()), fds)
+            finally:
+                for fd in close:
+                    os.close(fd)
+        reply = self.receive(self.replies, index)
+        if 'error' in reply:
+            for f in files.values():
+                f.close()
+            raise OSError(reply['error'])
+        return HelperProcess(self, index, reply['pid'], **files)
+
+
+class SudoHelper(ForkServer):
+    """A persistent process started once with sudo. It spawns the sudo
+    commands of the pipes run in a ``with`` block as root so sudo
+    authentication and setup are paid only once::
+
+        with sh.SudoHelper():
+            for filename in filenames:
+                sudo.chmod('600', filename)
+
+    Commands are run without a shell (like ``sudo cmd``). They get the
+    environment of the helper, as reset by sudo, plus the variables of the
+    ``env`` given to the command"""
+
+    error = 'Not able to run sudo.'
+    current = None
+    popen_kwargs = {}
+
+    def helper_args(self, path):
+        return [aliases.get('sudo'), sys.executable, '-c', FORK_SERVER, path]
+
+    def environ(self, kwargs):
+        # keep the environment reset by sudo. only add the variables given by
+        # the caller
+        return None, dict(kwargs.get('env') or {})
+
+    def __enter__(self):
+        if self.sock is None:
+            self.start()
+        self.previous, SudoHelper.current = SudoHelper.current, self
+        return self
+
+    def __exit__(self, *args):
+        SudoHelper.current = self.previous
+        self.close()
+
+
+class HelperProcess(object):
+    """A process spawned by a :class:`~chut.ForkServer`. Behave like a Popen
+    object"""
+
+    def __init__(self, helper, index, pid,
+                 stdin=None, stdout=None, stderr=None):
+        self.helper = helper
+        self.index = index
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            helper = self.helper
+            with helper.cond:
+                self.returncode = helper.returncodes.pop(self.index, None)
+                if self.returncode is None and helper.exited:
+                    raise OSError('fork server exited')
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            self.returncode = self.helper.receive(self.helper.returncodes,
+                                                  self.index)
+        return self.returncode
+
+    def kill(self):
+        self.helper.send(dict(kill=self.index))
+
+
+class SpawnedProcess(object):
+    """A process started with ``os.posix_spawn``. The memory of the current
+    process is not copied. Behave like a Popen object"""
+
+    def __init__(self, args, kwargs):
+        if kwargs.get('shell'):
+            args = ['/bin/sh', '-c', args]
+        args = list(args)
+        environ = kwargs.get('env')
+        if environ is None:
+            environ = os.environ
+        executable = kwargs.get('executable') or args[0]
+        executable = resolve(executable, environ.get('PATH', os.defpath))
+        if executable is None:
+            raise FileNotFoundError(errno.ENOENT, 'No such file', args[0])
+        self.args = args
+        self.returncode = None
+        self.stdin = self.stdout = self.stderr = None
+        actions = []
+        close = []
+        fds = []
+        for name in ('stdin', 'stdout', 'stderr'):
+            value = kwargs.get(name)
+            fd = len(fds)
+            if value == PIPE:
+                r, w = os.pipe()
+                if name == 'stdin':
+                    fd = r
+                    self.stdin = os.fdopen(w, 'wb')
+                else:
+                    fd = w
+                    setattr(self, name, os.fdopen(r, 'rb'))
+                close.append(fd)
+            elif value == DEVNULL:
+                fd = os.open(os.devnull, os.O_RDWR)
+                close.append(fd)
+            elif value == STDOUT:
+                fd = fds[-1]
+            elif isinstance(value, int):
+                fd = value
+            elif value is not None:
+                fd = value.fileno()
+            fds.append(fd)
+        for i, fd in enumerate(fds):
+            if fd != i:
+                actions.append((os.POSIX_SPAWN_DUP2, fd, i))
+            else:
+                os.set_inheritable(fd, True)
+        options = dict(file_actions=actions,
+                       setsid=kwargs.get('start_new_session', False))
+        if kwargs.get('process_group') is not None:
+            options['setpgroup'] = kwargs['process_group']
+        try:
+            self.pid = os.posix_spawn(
+                executable, args, dict(environ), **options)
+        finally:
+            for fd in close:
+                os.close(fd)
+
+    @classmethod
+    def supports(cls, kwargs):
+        """True if ``os.posix_spawn`` can be used with those Popen
+        arguments. Only inheritable file descriptors are passed to the
+        child so ``close_fds`` is always honored"""
+        if not hasattr(os, 'posix_spawn'):  # pragma: no cover
+            return False
+        cwd = kwargs.get('cwd')
+        if cwd is not None and os.path.abspath(cwd) != os.getcwd():
+            return False
+        kwargs = dict(kwargs)
+        kwargs.pop('process_group', None)
+        return ForkServer.supports(kwargs)
+
+    def _status(self, flags):
+        try:
+            pid, status = os.waitpid(self.pid, flags)
+        except ChildProcessError:  # pragma: no cover
+            pid, status = self.pid, 0
+        if pid == self.pid:
+            if os.WIFSIGNALED(status):
+                self.returncode = -os.WTERMSIG(status)
+            else:
+                self.returncode = os.WEXITSTATUS(status)
+        return self.returncode
+
+    def poll(self):
+        if self.returncode is None:
+            self._status(os.WNOHANG)
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None:
+            self._status(0)
+        return self.returncode
+
+    def send_signal(self, signum):
+        if self.returncode is None:
+            os.kill(self.pid, signum)
+
+    def kill(self):
+        self.send_signal(9)
+
+    def terminate(self):
+        self.send_signal(15)
+
+
+def launch(args, kwargs, launcher=None):
+    """Start a process and return a Popen like object. ``launcher`` can be:
+
+    - ``'popen'``: use ``subprocess.Popen`` (default)
+    - ``'spawn'``: use ``os.posix_spawn`` if the arguments allow it. Fallback
+      to the ``'forkserver'``
+    - ``'forkserver'``: ask the :class:`~chut.ForkServer` to spawn the process
+    """
+    if launcher == 'spawn':
+        if SpawnedProcess.supports(kwargs):
+            return SpawnedProcess(args, kwargs)
+        launcher = 'forkserver'
+    if launcher == 'forkserver' and ForkServer.supports(kwargs):
+        return ForkServer.get().popen(args, kwargs)
+    return Popen(args, **kwargs)
+
+
+_executables = {}
+
+
+def resolve(name, path=None):
+    """Return the absolute path of the executable ``name`` found in ``path``
+    (``env.path`` by default) or None. Found executables are cached per PATH
+    and are checked against the mtimes of the directories looked up"""
+    if os.sep in name:
+        return name
+    if path is None:
+        path = env.get('PATH', os.defpath)
+    if isinstance(path, (list, tuple)):
+        path = os.pathsep.join(path)
+    dirs = path.split(os.pathsep)
+    key = (name, path)
+    if not all(os.path.isabs(d) for d in dirs):
+        key += (os.getcwd(),)
+    cached = _executables.get(key)
+    if cached is not None:
+        executable, mtimes = cached
+        if all(_mtime(d) == mtime for d, mtime in mtimes):
+            return executable
+    mtimes = []
+    for dirname in dirs:
+        dirname = os.path.abspath(dirname)
+        mtimes.append((dirname, _mtime(dirname)))
+        filename = os.path.join(dirname, name)
+        if os.path.isfile(filename) and os.access(filename, os.X_OK):
+            _executables[key] = filename, mtimes
+            return filename
+    return None
+
+
+def _mtime(dirname):
+    try:
+        return os.stat(dirname).st_mtime_ns
+    except OSError:
+        return None
+
+
+def pyc(source, filename):
+    """Compile source. Return the cache tag of the interpreter and the content
+    of an unchecked hash based .pyc file"""
+    import importlib.util
+    import marshal
+    import warnings
+    with warnings.catch_warnings():
+        # warnings are for the authors of the embedded modules
+        warnings.simplefilter('ignore')
+        code = compile(source, filename, 'exec', dont_inherit=True)
+    header = importlib.util.MAGIC_NUMBER + b'\x01\x00\x00\x00'
+    header += importlib.util.source_hash(source)
+    return sys.implementation.cache_tag, header + marshal.dumps(code)
+
+
+def terminate(processes, pgid=None, delay=2):
+    """Send TERM to processes (and to the process group ``pgid``) then KILL
+    to those still running after ``delay`` seconds"""
+    import signal
+
+    def send(sig):
+        if pgid is not None:
+            try:
+                os.killpg(pgid, sig)
+            except OSError:
+                pass
+        for p in processes:
+            if p.poll() is None:
+                try:
+                    if sig == signal.SIGKILL:
+                        p.kill()
+                    elif hasattr(p, 'send_signal'):
+                        p.send_signal(sig)
+                except OSError:  # pragma: no cover
+                    pass
+
+    send(signal.SIGTERM)
+    end = time.time() + delay
+    while time.time() < end and any(p.poll() is None for p in processes):
+        time.sleep(.01)
+    send(signal.SIGKILL)
+
+
+def process_group(kwargs, pgid):
+    """Add the Popen arguments to start a process in the group ``pgid`` (or in
+    a new group if ``pgid`` is 0)"""
+    if sys.version_info >= (3, 11):
+        kwargs['process_group'] = pgid
+    else:  # pragma: no cover
+        kwargs['preexec_fn'] = functools.partial(os.setpgid, 0, pgid)
+    return kwargs
+
+
+def _is_path(value):
+    # a path can't exist if pathlib was never imported
+    pathlib = sys.modules.get('pathlib')
+    return pathlib is not None and isinstance(value, pathlib.PurePath)
 
 
 def escape(value):
@@ -128,9 +618,86 @@ def escape(value):
     return value
 
 
+def feed(fd, chunks, encoding='utf8', stats=None, source=None):
+    """Write chunks (bytes, buffers or strings) to a file descriptor then
+    close it. Written bytes are added to ``stats.written`` and to
+    ``source.read``"""
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(encoding)
+            view = memoryview(chunk).cast('B')
+            while view:
+                size = os.write(fd, view)
+                view = view[size:]
+                if stats is not None:
+                    stats.written += size
+                if source is not None:
+                    source.read += size
+    except BrokenPipeError:
+        # the consumer exited before reading everything
+        pass
+    finally:
+        os.close(fd)
+
+
+class CountingReader(io.RawIOBase):
+    """A binary file reading from the unbuffered stream of ``file``. The bytes
+    read are added to ``stats.read``"""
+
+    def __init__(self, file, stats):
+        # keep a reference to the file. the stream is closed with it
+        self.file = file
+        self.raw = getattr(file, 'raw', file)
+        self.stats = stats
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.raw.readinto(buffer)
+        if size:
+            self.stats.read += size
+        return size
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super(CountingReader, self).close()
+
+
+def copy_fd(src, dst, size=2 ** 20):
+    """Copy all data from a file descriptor to another. Data is moved by the
+    kernel with ``os.splice`` or ``os.sendfile`` when possible"""
+    funcs = []
+    if hasattr(os, 'splice'):
+        funcs.append(lambda: os.splice(src, dst, size))
+    if hasattr(os, 'sendfile'):
+        funcs.append(lambda: os.sendfile(dst, src, None, size))
+    for func in funcs:
+        try:
+            copied = func()
+        except OSError as e:
+            # not supported by those file descriptors
+            if e.errno in (errno.EINVAL, errno.ENOSYS, errno.EBADF):
+                continue
+            raise
+        while copied:
+            copied = func()
+        return
+    for chunk in iter(functools.partial(os.read, src, size), b''):
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(dst, view):]
+
+
 def ini(filename, **defaults):
     """Load a .ini file in a ConfigObject. Dont raise if the file does not
     exist"""
+    from ConfigObject import ConfigObject
     filename = sh.path(filename)
     defaults.update(home=sh.path('~'))
     return ConfigObject(filename=filename, defaults=defaults)
@@ -205,6 +772,7 @@ class Path(object):
         else:
             value = str()
         if value and 'obj' in kwargs or 'object' in kwargs:
+            import pathlib
             value = pathlib.Path(value)
         return value
 
@@ -215,13 +783,24 @@ class Pipe(object):
     _chut = None
     _pipe = True
     _cmd_args = []
+    _options = ('max_stdout', 'max_stderr', 'launcher',
+                'timeout', 'idle_timeout', 'stats')
+    launcher = 'popen'
+    kill_delay = 2
+    _pgid = None
+    _timed_out = None
+    _stats = None
+    _span = None
     _sys_stdout = sys.stdout
     _sys_stderr = sys.stderr
 
     def __init__(self, *args, **kwargs):
-        self._done = False
-        self._stdout = None
+        self._result = None
+        self._started = None
         self._stderr = None
+        self._reading = None
+        self._pending = None
+        self._argv = None
         self.args = list(args)
         self.previous = None
         self.processes = []
@@ -244,21 +823,37 @@ class Pipe(object):
             self._call_pipe()
 
     def _call_pipe(self):
-        self._done = True
         ret = self.__call__()
         if ret.failed:
             print(ret.stderr, file=sys.stderr)
 
+    @property
+    def result(self):
+        """The :class:`~chut.Stdout` of the last run or None if the pipe has
+        not been run yet"""
+        return self._result
+
     @property
     def returncodes(self):
         """A list of return codes of all processes launched by the pipe"""
+        if self._result is not None:
+            return self._result.returncodes
+        return self._returncodes()
+
+    def _returncodes(self):
+        """Wait for the processes and return their return codes"""
         for p in self.processes:
             p.wait()
-        codes = [p.poll() for p in self.processes]
+        codes = self._input_codes() + [p.poll() for p in self.processes]
         if set(codes) == set([0]):
             return []
         return codes
 
+    def _input_codes(self):
+        """A return code of 1 for each input which failed to be read"""
+        return [1 for cmd in self.commands
+                if isinstance(cmd, Stdin) and cmd._error is not None]
+
     @property
     def failed(self):
         """True if one or more process failed"""
@@ -276,6 +871,12 @@ class Pipe(object):
     @property
     def stderr(self):
         """combined stderr of all processes"""
+        if self._result is not None:
+            return self._result.stderr
+        return self._read_stderr()
+
+    def _read_stderr(self):
+        """Read the stderr of the processes if it has not been drained"""
         if self._stderr is None:
             stderr = [p.stderr.read() for p in self.processes if p.stderr]
             output = b'\n'.join(stderr).strip()
@@ -294,6 +895,17 @@ class Pipe(object):
         return cmds
 
     def command_line(self, shell=False):
+        """Return the argv of the command (or a string if ``shell`` is true).
+        The result is cached until ``args`` or the sudo alias change"""
+        key = (shell, aliases.get('sudo'), [
+            tuple(a) if isinstance(a, (list, tuple)) else a
+            for a in self.args])
+        if self._argv is None or self._argv[0] != key:
+            self._argv = key, self._command_line(shell)
+        argv = self._argv[1]
+        return argv if shell else list(argv)
+
+    def _command_line(self, shell):
         args = []
 
         if self._cmd_args:
@@ -328,74 +940,272 @@ class Pipe(object):
 
     @property
     def commands_line(self):
-        cmds = []
-        for cmd in self.commands:
-            if isinstance(cmd, Stdin):
-                s = 'stdin'
-            elif isinstance(cmd, PyPipe):
-                s = '%s()' % cmd.__class__.__name__
-            elif cmd.kwargs.get("shell"):
-                s = cmd.command_line(shell=True)
-            else:
-                args = []
-                for arg in cmd.command_line():
-                    if any(i in arg for i in '\'"*<>|& '):
-                        args.append(repr(str(arg)))
-                    else:
-                        args.append(arg)
-                s = " ".join(args)
-            cmds.append(s.strip())
-        return str(' | '.join(cmds))
+        return str(' | '.join(cmd._stage_line() for cmd in self.commands))
+
+    def _stage_line(self):
+        """The command line of this command only"""
+        if isinstance(self, Stdin):
+            s = 'stdin'
+        elif isinstance(self, PyPipe):
+            s = '%s()' % self.__class__.__name__
+        elif self.kwargs.get("shell"):
+            s = self.command_line(shell=True)
+        else:
+            args = []
+            for arg in self.command_line():
+                if any(i in arg for i in '\'"*<>|& '):
+                    args.append(repr(str(arg)))
+                else:
+                    args.append(arg)
+            s = " ".join(args)
+        return str(s.strip())
 
     def bg(self):
         """Run processes in background. Return the last piped Popen object"""
         p = None
         self.processes = []
         self._stderr = None
+        self._started = time.time()
+        self._pgid = self._timed_out = None
+        # processes which may be killed by a timeout run in their own group
+        grouped = self._option('timeout') is not None or \
+            self._option('idle_timeout') is not None
+        stats = None
+        if self._option('stats') or trace.active:
+            stats = []
+        self._stats = stats
+        self._span = None
+        if trace.active:
+            self._span = trace.new_id(), trace.current
+        stage = pending = None
         stdin = sys.stdin
         cmds = self.commands
 
-        if [c for c in cmds if c._cmd_args[:1] == ['sudo']]:
+        helper = SudoHelper.current
+        if helper is None and [c for c in cmds
+                               if c._cmd_args[:1] == ['sudo']]:
             check_sudo()
 
         for cmd in cmds:
+            if isinstance(cmd, Stdin):
+                # count the bytes written to the next stage
+                pending = cmd._consumer = Stats() if stats is not None \
+                    else None
+            elif stats is not None:
+                stage = pending or Stats()
+                stage.command = cmd._stage_line()
+                stage.started = time.time()
+                stats.append(stage)
+                pending = None
             if isinstance(cmd, Stdin):
                 stdin = cmd.iter_stdout
             elif isinstance(cmd, PyPipe):
-                cmd.stdin = p.stdout
-                stdin = cmd.iter_stdout
-                p = cmd
+                owned = isinstance(stdin, int) or stdin is getattr(
+                    p, 'stdout', None)
+                if isinstance(stdin, int):
+                    stdin = os.fdopen(stdin, 'rb')
+                stdin = getattr(stdin, 'buffer', stdin)
+                if owned and (cmd is self or cmd.backend != 'process'):
+                    stdin = self._count_input(stdin, stats)
+                if cmd is self:
+                    cmd.stdin = stdin
+                    p = cmd
+                else:
+                    # run the function concurrently and connect it to the
+                    # next process with a real pipe
+                    r, w = os.pipe()
+                    if stats is not None:
+                        pending = Stats()
+                    p = Worker(cmd, stdin, w, owned=owned,
+                               pgid=(self._pgid or 0) if grouped else None,
+                               stats=pending, source=stage)
+                    if stats is not None:
+                        stage.spawned(p)
+                    if grouped and p.pid and self._pgid is None:
+                        self._pgid = p.pid
+                    self.processes.append(p)
+                    stdin = r
             else:
-                args = cmd.command_line(cmd.kwargs.get('shell', False))
-
-                kwargs = dict(
-                    stdin=stdin, stderr=PIPE,
-                    stdout=PIPE
-                )
-                kwargs.update(cmd.kwargs)
-                env_ = kwargs.pop('env', env)
-
-                log.debug('Popen(%r, **%r)', args, kwargs)
-
-                kwargs['env'] = env_
+                args, kwargs = cmd._popen_args(stdin)
 
                 try:
-                    p = Popen(args, **kwargs)
+                    if helper is not None and not kwargs.get('shell') and \
+                       cmd._cmd_args[:1] == ['sudo']:
+                        kwargs.pop('executable', None)
+                        if 'env' not in cmd.kwargs:
+                            kwargs.pop('env', None)
+                        p = helper.popen(args[len(cmd._cmd_args):], kwargs)
+                    else:
+                        if grouped:
+                            process_group(kwargs, self._pgid or 0)
+                        p = launch(args, kwargs, cmd.kwargs.get(
+                            'launcher', cmd.launcher))
+                        if grouped and self._pgid is None:
+                            self._pgid = p.pid
                 except OSError:
                     self._raise()
+                if stats is not None:
+                    stage.spawned(p)
+
+                if isinstance(stdin, int):
+                    # read end of a Stdin pipe. now owned by the process
+                    os.close(stdin)
 
                 self.processes.append(p)
                 stdin = p.stdout
         return p
 
+    def _count_input(self, stdin, stats):
+        """Count the bytes a python stage reads from the previous stage"""
+        if not stats or len(stats) < 2:
+            return stdin
+        return io.BufferedReader(CountingReader(stdin, stats[-2]))
+
+    def _option(self, name):
+        """Return an option given to any command of the pipe. The last one
+        wins"""
+        for cmd in reversed(self.commands):
+            value = cmd.kwargs.get(name)
+            if value is not None:
+                return value
+
+    def kill(self):
+        """Kill the running processes of the pipe and their children. Send
+        TERM then KILL after ``kill_delay`` seconds"""
+        terminate(self.processes, self._pgid, self.kill_delay)
+
+    async def abg(self):
+        """Run processes in background using asyncio. Return the
+        ``asyncio.StreamReader`` of the last process stdout. Python functions
+        run in a :class:`~chut.Worker`"""
+        import asyncio
+        p = None
+        self.processes = []
+        self._stderr = None
+        self._started = time.time()
+        self._pgid = self._timed_out = None
+        grouped = self._option('timeout') is not None or \
+            self._option('idle_timeout') is not None
+        # the resource usage is not available. processes are reaped by asyncio
+        stats = self._stats = [] if self._option('stats') else None
+        stage = pending = None
+        stdin = sys.stdin
+        cmds = self.commands
+
+        if [c for c in cmds if c._cmd_args[:1] == ['sudo']]:
+            # do not block the loop while sudo is checked
+            await asyncio.get_event_loop().run_in_executor(None, check_sudo)
+
+        for cmd in cmds:
+            if isinstance(cmd, Stdin):
+                # count the bytes written to the next stage
+                pending = cmd._consumer = Stats() if stats is not None \
+                    else None
+            elif stats is not None:
+                stage = pending or Stats()
+                stage.command = cmd._stage_line()
+                stage.started = time.time()
+                stats.append(stage)
+                pending = None
+            if isinstance(cmd, Stdin):
+                stdin = cmd.iter_stdout
+            elif isinstance(cmd, PyPipe):
+                owned = isinstance(stdin, int)
+                if owned:
+                    stdin = os.fdopen(stdin, 'rb')
+                stdin = getattr(stdin, 'buffer', stdin)
+                if owned and cmd.backend != 'process':
+                    stdin = self._count_input(stdin, stats)
+                r, w = os.pipe()
+                if stats is not None:
+                    pending = Stats()
+                # the output of the last stage is counted by the reader
+                p = Worker(cmd, stdin, w, owned=owned,
+                           pgid=(self._pgid or 0) if grouped else None,
+                           stats=pending,
+                           source=stage if cmd is not self else None)
+                if stats is not None:
+                    stage.spawned(p)
+                if grouped and p.pid and self._pgid is None:
+                    self._pgid = p.pid
+                self.processes.append(p)
+                stdin = r
+            else:
+                args, kwargs = cmd._popen_args(stdin)
+                if grouped:
+                    process_group(kwargs, self._pgid or 0)
+                w = None
+                if cmd is not self and kwargs['stdout'] == PIPE:
+                    # processes are connected with os pipes
+                    stdin, w = os.pipe()
+                    kwargs['stdout'] = w
+
+                try:
+                    if kwargs.pop('shell', False):
+                        p = await asyncio.create_subprocess_shell(
+                            args, **kwargs)
+                    else:
+                        p = await asyncio.create_subprocess_exec(
+                            *args, **kwargs)
+                except OSError:
+                    self._raise()
+                finally:
+                    for fd in (w, kwargs['stdin']):
+                        if isinstance(fd, int):
+                            os.close(fd)
+                if stats is not None:
+                    stage.spawned(p)
+
+                if grouped and self._pgid is None:
+                    self._pgid = p.pid
+                self.processes.append(p)
+        if isinstance(p, Worker):
+            # read the output of the last function
+            reader = asyncio.StreamReader()
+            await asyncio.get_event_loop().connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader),
+                os.fdopen(stdin, 'rb'))
+            return reader
+        return p.stdout
+
+    def _spawn_args(self, shell=False):
+        """The command line used to spawn the process"""
+        args = self.command_line(shell)
+        if isinstance(self._chut, SSH) and not shell:
+            args = self._chut.spawn_args(args)
+        return args
+
+    def _popen_args(self, stdin):
+        args = self._spawn_args(self.kwargs.get('shell', False))
+
+        kwargs = dict(
+            stdin=stdin, stderr=PIPE,
+            stdout=PIPE
+        )
+        kwargs.update(self.kwargs)
+        for option in self._options:
+            kwargs.pop(option, None)
+        env_ = kwargs.pop('env', env)
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Popen(%r, **%r)', args, kwargs)
+
+        kwargs['env'] = env_
+        if not kwargs.get('shell') and 'executable' not in kwargs:
+            # avoid the lookup of PATH on each spawn
+            executable = resolve(args[0], env_.get('PATH', os.defpath))
+            if executable:
+                kwargs['executable'] = executable
+        return args, kwargs
+
     def execv(self):
         cmd = self.command_line()
-        binary = sh.which(cmd.pop(0))
+        name = cmd.pop(0)
+        binary = resolve(name)
         if binary:
-            binary = str(binary)
             os.execve(binary, [binary] + cmd, env)
         else:
-            raise OSError(binary)
+            raise OSError(name)
 
     @property
     def stdout(self):
@@ -407,10 +1217,13 @@ class Pipe(object):
             return p.stdout
 
     @classmethod
-    def map(cls, args,
-            pool_size=None, stop_on_failure=False, **kwargs):
+    def map(cls, args, pool_size=None, stop_on_failure=False,
+            timeout=None, idle_timeout=None, **kwargs):
         """Run a batch of the same command and manage a pool of processes for
-        you"""
+        you. Yield results in the order of ``args``. A job is killed after
+        ``timeout`` seconds or after ``idle_timeout`` seconds without
+        output. Use ``stats=True`` to get the :class:`~chut.Stats` of each
+        job"""
         kw = dict(
             stdin=sys.stdin, stderr=PIPE,
             stdout=PIPE
@@ -419,42 +1232,8 @@ class Pipe(object):
         if pool_size is None:
             import multiprocessing
             pool_size = multiprocessing.cpu_count()
-        results = [None] * len(args)
-        processes = []
-        index = 0
-        out_index = 0
-        while args or processes:
-            if args and len(processes) < pool_size:
-                a = args.pop(0)
-                if not isinstance(a, list):
-                    a = [a]
-                cmd = cls(*a)
-                a = cmd.command_line(cmd.kwargs.get('shell', False))
-                processes.append((index, cmd, Popen(a, **kw)))
-                index += 1
-            for i, cmd, p in processes:
-                result = p.poll()
-                if result is not None:
-                    output = Stdout(p.stdout.read())
-                    output.stderr = p.stderr.read()
-                    output.returncodes = [result]
-                    output.failed = bool(result)
-                    output.succeeded = not output.failed
-                    results[i] = output
-                    processes.remove((i, cmd, p))
-                    if out_index == i:
-                        out_index += 1
-                        yield results[i]
-                    if result > 0 and stop_on_failure:
-                        args = None
-                        for index, cmd, p in processes:
-                            if p.poll() is None:  # pragma: no cover
-                                p.kill()
-                        cmd._raise(output=output)
-            time.sleep(.1)
-        if out_index < len(results):  # pragma: no cover
-            yield results[out_index]
-            out_index += 1
+        return iter(Batch(cls, args, pool_size, stop_on_failure, kw,
+                          timeout=timeout, idle_timeout=idle_timeout))
 
     def __getitem__(self, item):
         if not isinstance(item, slice):
@@ -469,15 +1248,91 @@ class Pipe(object):
         return self._order(cmds)[-1]
 
     def __iter__(self):
-        eol = '\n'
-        for line in self.stdout:
-            yield self._decode(line).rstrip(eol)
-        if self.failed:
-            self._raise(output=self._get_stdout(''))
+        return self.iter_lines()
+
+    def iter_lines(self, raw=False, chunk_size=65536):
+        """Iterate over the lines of the output. Lines are split from large
+        chunks. They are not decoded if ``raw`` is true. When the last command
+        is a python function, each item it yields is a line"""
+        eol = b'\n'
+        decode = bytes if raw else self._decode
+        if isinstance(self, PyPipe):
+            for item in self.iter_bytes(chunk_size):
+                if isinstance(item, str):
+                    item = item.encode(self.encoding)
+                yield decode(item.rstrip(eol))
+            return
+        # keep the pieces of an unfinished line. they are joined once the end
+        # of the line is found so long lines are not copied for each chunk
+        pieces = []
+        for chunk in self.iter_bytes(chunk_size):
+            start = 0
+            end = chunk.find(eol)
+            while end != -1:
+                pieces.append(chunk[start:end])
+                yield decode(b''.join(pieces))
+                pieces = []
+                start = end + 1
+                end = chunk.find(eol, start)
+            if start < len(chunk):
+                pieces.append(chunk[start:])
+        if pieces:
+            yield decode(b''.join(pieces))
+
+    def iter_bytes(self, chunk_size=65536):
+        """Iterate over chunks of the output. Data is not decoded"""
+        for chunk in self._iter_chunks(chunk_size):
+            yield chunk
+        # stdout has been consumed by the iteration. store the status only
+        self._result = self._get_stdout('', consumed=True)
+        if self._result.failed:
+            self._raise(output=self._result)
+
+    def readinto(self, buffer):
+        """Read the output into a writable buffer. The pipe is started at the
+        first call. Return the number of bytes read or 0 at the end of the
+        output. Use :meth:`rerun` to read the output of a new run"""
+        if self._reading is None:
+            self._reading = self.iter_bytes()
+            self._pending = memoryview(b'')
+        if not self._pending:
+            chunk = next(self._reading, b'')
+            if not chunk:
+                # stay at the end of the output
+                return 0
+            self._pending = memoryview(chunk)
+        view = memoryview(buffer).cast('B')
+        size = min(len(view), len(self._pending))
+        view[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def __aiter__(self):
+        return AsyncReader(self, lines=True).iterate()
+
+    def __await__(self):
+        return self._await().__await__()
+
+    async def _await(self):
+        if self._result is None:
+            reader = AsyncReader(self)
+            chunks = []
+            async for chunk in reader.iterate():
+                chunks.append(chunk)
+            output = self._decode(b''.join(chunks).rstrip())
+            self._result = self._get_stdout(output, reader.returncodes)
+        return self._result
 
     def __call__(self, **kwargs):
-        if self._done and self._stdout is not None:
-            return self._stdout
+        """Run the pipe once and return its :class:`~chut.Stdout`. Later calls
+        return the stored result. Use :meth:`rerun` to run the pipe again.
+        Calling the pipe with keyword arguments always runs it again"""
+        if self._result is not None and not kwargs:
+            return self._result
+        return self.rerun(**kwargs)
+
+    def rerun(self, **kwargs):
+        """Run the pipe again and replace the stored result"""
         for cmd in self.commands:
             if kwargs.get('shell'):
                 cmd.kwargs['shell'] = True
@@ -485,23 +1340,91 @@ class Pipe(object):
                 cmd.kwargs['stderr'] = STDOUT
             if kwargs.get('stderr'):
                 cmd.kwargs['stderr'] = STDOUT
+        self._reading = self._pending = None
+        return self._run()
+
+    def _run(self):
+        output = b''.join(self._iter_chunks()).rstrip()
+        self._result = self._get_stdout(self._decode(output))
+        return self._result
+
+    def _iter_chunks(self, chunk_size=None):
+        """Run the pipe and yield chunks of its stdout while the stderr of all
+        processes is drained"""
         stdout = self.stdout
-        if stdout is not None:
-            if hasattr(stdout, 'read'):
-                output = stdout.read().rstrip()
-            else:  # pragma: no cover
-                output = b''.join(list(stdout)).rstrip()
-            output = self._decode(output)
-        else:
-            output = ''
-        output = self._get_stdout(output)
-        if self._done:
-            self._stdout = output
-        return output
+        stderr = [p.stderr for p in self.processes if p.stderr]
+        timeout = self._option('timeout')
+        reader = Reader(stdout, stderr,
+                        max_stdout=self._option('max_stdout'),
+                        max_stderr=self._option('max_stderr'),
+                        timeout=timeout,
+                        idle_timeout=self._option('idle_timeout'),
+                        expire=self._expire,
+                        watch=self._reap if self._stats is not None else None)
+        if chunk_size:
+            reader.chunk_size = chunk_size
+        try:
+            for chunk in reader:
+                yield chunk
+            if timeout is not None and not reader.expired:
+                # stdout may be redirected. wait for the processes
+                deadline = self._started + timeout
+                while any(p.poll() is None for p in self.processes):
+                    if time.time() >= deadline:
+                        self._expire()
+                        break
+                    time.sleep(.01)
+            if self._stats is not None:
+                self._collect(reader.counts)
+            if self._span is not None:
+                self._trace()
+        except BaseException:
+            # cancelled. do not leave the processes behind
+            if self._pgid is not None:
+                self.kill()
+            raise
+        output = b'\n'.join(reader.stderr).strip()
+        self._stderr = output.decode(self.encoding, 'ignore')
+
+    def _reap(self):
+        for stage in self._stats:
+            stage.reap(os.WNOHANG)
+
+    def _collect(self, counts):
+        """Wait for all stages and add the bytes read by the reader"""
+        stats = self._stats
+        owners = [s for s in stats if s.process is not None and
+                  s.process.stderr]
+        for i, stage in enumerate(owners):
+            stage.read += counts[i]
+        stats[-1].read += counts[None]
+        for stage in stats:
+            stage.reap()
+
+    def _trace(self):
+        id, parent = self._span
+        cat = 'ssh' if isinstance(self._chut, SSH) else 'pipe'
+        trace.emit(self.commands_line, cat, self._started, time.time(), id,
+                   parent, returncodes=[s.returncode for s in self._stats],
+                   timed_out=self._timed_out)
+        trace.emit_stats(self._stats, 'stage', id)
+
+    def _expire(self):
+        """Kill the pipe on timeout. Record the first stage still running"""
+        cmds = [c for c in self.commands if not isinstance(c, Stdin)]
+        for cmd, p in zip(cmds, self.processes + [None]):
+            if p is None or p.poll() is None:
+                self._timed_out = cmd._stage_line()
+                break
+        self.kill()
 
     def __str__(self):
         output = self.__call__()
-        if self.failed:
+        if output.consumed:
+            raise ValueError(
+                'The output of %s has been consumed by an iteration. '
+                'Use rerun()' % self.commands_line)
+        if output.failed:
             self._raise(output=output)
         return output
 
@@ -511,14 +1434,18 @@ class Pipe(object):
     def __rshift__(self, filename):
         return self._write(filename, 'ab+')
 
+    def __lt__(self, filename):
+        import pathlib
+        return Stdin(pathlib.Path(filename)) | self
+
     def __or__(self, other):
         if isinstance(other.commands, property):
             other = other()
         if isinstance(self, Stdin):
-            first = other.commands[0]
-            first.previous = self
-            return other
-        cmds = deepcopy(self.commands) + deepcopy(other.commands)
+            # do not copy the input. it may be a file or an iterator
+            cmds = [self] + deepcopy(other.commands)
+        else:
+            cmds = deepcopy(self.commands) + deepcopy(other.commands)
         cmds = self._order(cmds)
         other = cmds[-1]
         return other
@@ -542,12 +1469,19 @@ class Pipe(object):
 
     def _write_to(self, fd):
         if not isinstance(self, PyPipe):
+            stdout = self.kwargs.get('stdout')
             self.kwargs['stdout'] = fd
-            return self.__call__()
+            try:
+                return self._run()
+            finally:
+                self.kwargs['stdout'] = stdout
+                if stdout is None:
+                    del self.kwargs['stdout']
         else:
-            for line in self.stdout:
-                fd.write(line)
-            return self._get_stdout('')
+            for chunk in self._iter_chunks():
+                fd.write(chunk)
+            self._result = self._get_stdout('')
+            return self._result
 
     def _write(self, filename, mode):
         if filename in (0,):
@@ -571,15 +1505,17 @@ class Pipe(object):
             output = output.decode(self.encoding)
         return output
 
-    def _get_stdout(self, stdout):
+    def _get_stdout(self, stdout, returncodes=None, consumed=False):
         if not isinstance(stdout, str):
             stdout = stdout.encode(self.encoding)
-        output = Stdout(stdout)
-        output.stderr = self.stderr
-        output.returncodes = self.returncodes
-        output.failed = bool(output.returncodes)
-        output.succeeded = not output.failed
-        return output
+        if returncodes is None:
+            returncodes = self._returncodes()
+        return Stdout(stdout, stderr=self._read_stderr(),
+                      returncodes=returncodes,
+                      started=self._started, ended=time.time(),
+                      timed_out=self._timed_out,
+                      stats=self._stats if self._option('stats') else None,
+                      consumed=consumed)
 
     def _raise(self, output=None):
         if not log.handlers:
@@ -587,77 +1523,1071 @@ class Pipe(object):
         if output is not None:
             if output.stderr:
                 log.error(output.stderr)
+            if output.timed_out:
+                log.error('Timed out: %s', output.timed_out)
             raise OSError(self.commands_line, output.stderr)
         raise OSError(self.commands_line)
 
 
 class Stdin(Pipe):
-    """Used to inject some data in the pipe"""
+    """Used to inject some data in the pipe. ``value`` can be some bytes, a
+    string (encoded with ``encoding``), a memoryview, a file object, a
+    ``pathlib.Path`` or an iterator. Files are passed as is to the first
+    process. Other data is streamed to the pipe by a writer thread. Notice
+    that an iterator can only be consumed once"""
 
     stderr = ''
     returncodes = []
+    chunk_size = 65536
+    _consumer = None  # the Stats of the next stage
+    _error = None  # the exception raised while reading the input
 
-    def __init__(self, value):
-        super(Stdin, self).__init__()
+    def __init__(self, value, encoding=None):
+        super(Stdin, self).__init__(encoding=encoding)
         self.value = value
         self._stdin = None
 
     @property
     def iter_stdout(self):
+        if _is_path(self.value):
+            return os.open(str(self.value), os.O_RDONLY)
+        if self._fileno() is not None:
+            return self.value
+        r, w = os.pipe()
+        self._error = None
+        thread = threading.Thread(target=feed,
+                                  args=(w, self._checked_chunks()),
+                                  kwargs=dict(stats=self._consumer))
+        thread.daemon = True
+        thread.start()
+        return r
+
+    def _fileno(self):
         if hasattr(self.value, 'seek'):
             self.value.seek(0)
-        if hasattr(self.value, 'fileno'):
-            r = self.value
+        try:
+            return self.value.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            return None
+
+    def _chunks(self):
+        value = self.value
+        size = self.chunk_size
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            yield value
+        elif isinstance(value, str):
+            for i in range(0, len(value), size):
+                yield value[i:i + size].encode(self.encoding)
         else:
-            if hasattr(self.value, 'read'):
-                value = self.value.read()
-            else:
-                if not isinstance(self.value, bytes):
-                    value = self.value.encode('ascii')
-                else:
-                    value = self.value
-            r, w = os.pipe()
-            fd = os.fdopen(w, 'wb')
-            fd.write(value)
-            fd.close()
-        return r
+            if hasattr(value, 'read'):
+                read = functools.partial(value.read, size)
+                value = iter(read, value.read(0))
+            for chunk in value:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode(self.encoding)
+                yield chunk
+
+    def _checked_chunks(self):
+        # record the error before the pipe is closed so the pipe fails
+        # instead of succeeding on a truncated input
+        try:
+            for chunk in self._chunks():
+                yield chunk
+        except Exception as e:
+            log.exception('Failed to read the input of the pipe')
+            self._error = e
 
     def __deepcopy__(self, *args):
-        return self.__class__(self.value)
+        return self.__class__(self.value, encoding=self.kwargs['encoding'])
 
     def _write(self, filename, mode):
         with open(filename, mode) as fd:
-            if hasattr(self.value, 'seek'):
-                self.value.seek(0)
-            if hasattr(self.value, 'read'):
-                shutil.copyfileobj(self.value, fd)
+            if _is_path(self.value):
+                src = self.iter_stdout
+                try:
+                    copy_fd(src, fd.fileno())
+                finally:
+                    os.close(src)
+            elif self._fileno() is not None:
+                copy_fd(self.value.fileno(), fd.fileno())
             else:
-                fd.write(self.value)
+                for chunk in self._chunks():
+                    fd.write(chunk)
         return self._get_stdout('')
 
 
 class Stdout(str):
-    """A string with extra attributes:
+    """A read only string with extra attributes:
 
     - succeeded
     - failed
     - stdout
     - stderr
+    - returncodes
+    - started / ended / duration (timings in seconds)
+    - timed_out (the command line of the stage killed by a timeout or None)
+    - stats (a list of :class:`~chut.Stats`, one per stage, or None)
+    - consumed (True when stdout has been read by an iteration and is not
+      stored)
     """
 
+    def __new__(cls, value='', stderr='', returncodes=(),
+                started=None, ended=None, timed_out=None, stats=None,
+                consumed=False):
+        self = super(Stdout, cls).__new__(cls, value)
+        attrs = dict(stderr=stderr, returncodes=list(returncodes),
+                     started=started, ended=ended, timed_out=timed_out,
+                     stats=stats, consumed=consumed)
+        self.__dict__.update(attrs)
+        return self
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('%s is read only' % self.__class__.__name__)
+
+    __delattr__ = __setattr__
+
     @property
     def stdout(self):
         return self
 
+    @property
+    def failed(self):
+        return any(self.returncodes)
+
+    @property
+    def succeeded(self):
+        return not self.failed
+
+    @property
+    def duration(self):
+        if self.started is None or self.ended is None:
+            return None
+        return self.ended - self.started
+
+
+class Stats(object):
+    """Timings and resources used by a stage of a pipe. Collected when the
+    ``stats`` option is true:
+
+    - command
+    - spawn (seconds spent to start the process)
+    - started / ended / wall (timings in seconds)
+    - user / sys (CPU seconds) and maxrss (kilobytes on linux). Read from
+      ``os.wait4``. None if the process is not a child of the current
+      process or has already been reaped
+    - read (bytes read by chut from the stdout and stderr of the stage. The
+      output of a python stage is read by chut)
+    - written (bytes written by chut to the stdin of the stage)
+
+    Python stages running in a forked process are not counted. Async pipes
+    do not collect the resource usage
+    - returncode
+    """
+
+    def __init__(self, command=None):
+        self.command = command
+        self.process = None
+        self.spawn = 0
+        self.started = time.time()
+        self.ended = None
+        self.user = self.sys = self.maxrss = None
+        self.read = self.written = 0
+        self.returncode = None
+
+    def spawned(self, process):
+        self.process = process
+        self.spawn = time.time() - self.started
+
+    @property
+    def wall(self):
+        if self.ended is None:
+            return None
+        return self.ended - self.started
+
+    def reap(self, flags=0):
+        """Wait for the process and collect its resource usage. Return true
+        when the process exited"""
+        if self.ended is not None:
+            return True
+        p = self.process
+        if p is not None and p.returncode is None and \
+           getattr(p, 'pid', None) and not isinstance(p, HelperProcess):
+            try:
+                pid, status, usage = os.wait4(p.pid, flags)
+            except ChildProcessError:  # pragma: no cover
+                pid = None
+            if pid == 0:
+                return False
+            if pid is not None:
+                if os.WIFSIGNALED(status):
+                    p.returncode = -os.WTERMSIG(status)
+                else:
+                    p.returncode = os.WEXITSTATUS(status)
+                self.user = usage.ru_utime
+                self.sys = usage.ru_stime
+                self.maxrss = usage.ru_maxrss
+        if p is not None:
+            if flags and p.poll() is None:
+                return False
+            self.returncode = p.wait()
+        self.ended = time.time()
+        return True
+
+    def __repr__(self):
+        values = ['%s=%s' % (k, round(v, 3) if isinstance(v, float) else v)
+                  for k, v in (('spawn', self.spawn), ('wall', self.wall),
+                               ('user', self.user), ('sys', self.sys),
+                               ('maxrss', self.maxrss), ('read', self.read),
+                               ('written', self.written),
+                               ('returncode', self.returncode))]
+        return '<Stats %r %s>' % (self.command, ' '.join(values))
+
+
+class Tracer(object):
+    """Record spans of pipes, stages, map jobs, ssh calls and script
+    generation in a file. Use ``sh.trace.start(path)`` or set the
+    ``CHUT_TRACE`` environment variable. Files ending with ``.jsonl`` get one
+    event per line. Others use the Chrome trace format (open them in
+    ``chrome://tracing`` or Perfetto). Each event has an ``id`` and the
+    ``parent`` id in its ``args``. Stages and jobs are shown on the track of
+    their process id"""
+
+    def __init__(self):
+        self.fd = None
+        self.path = None
+        self.format = None
+        self.local = threading.local()
+        self.ids = itertools.count(1)
+        self.registered = False
+
+    @property
+    def active(self):
+        return self.fd is not None
+
+    def start(self, path, format=None, append=False):
+        """Start to record events in ``path``. Events are appended to an
+        existing file if ``append`` is true"""
+        if self.active:
+            self.stop()
+        if format is None:
+            format = 'jsonl' if path.endswith('.jsonl') else 'chrome'
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        if not append:
+            flags |= os.O_TRUNC
+        fd = os.open(path, flags, 0o644)
+        if format == 'chrome' and not os.fstat(fd).st_size:
+            # the closing bracket is optional in this format. events can be
+            # appended by forked processes
+            os.write(fd, b'[\n')
+        self.fd, self.path, self.format = fd, path, format
+        if not self.registered:
+            import atexit
+            atexit.register(self.stop)
+            self.registered = True
+        return self
+
+    def stop(self):
+        """Stop recording"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def new_id(self):
+        return '%s.%s' % (os.getpid(), next(self.ids))
+
+    @property
+    def current(self):
+        """The id of the innermost span of the current thread"""
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def span(self, name, cat='user', **args):
+        """Record a span around a block of code. Spans started inside the
+        block are its children"""
+        if not self.active:
+            yield None
+            return
+        id, parent = self.new_id(), self.current
+        stack = self.local.__dict__.setdefault('stack', [])
+        stack.append(id)
+        started = time.time()
+        try:
+            yield id
+        finally:
+            stack.pop()
+            self.emit(name, cat, started, time.time(), id, parent, **args)
+
+    def emit(self, name, cat, started, ended, id=None, parent=None,
+             tid=None, **args):
+        """Write a complete event"""
+        fd = self.fd
+        if fd is None:
+            return
+        import json
+        args.update(id=id or self.new_id(), parent=parent)
+        event = dict(name=name, cat=cat, ph='X', ts=started * 1e6,
+                     dur=(ended - started) * 1e6, pid=os.getpid(),
+                     tid=tid or threading.get_ident(), args=args)
+        data = json.dumps(event, default=str)
+        data += ',\n' if self.format == 'chrome' else '\n'
+        try:
+            # a single write. lines of concurrent processes do not mix
+            os.write(fd, data.encode('utf8'))
+        except OSError:  # pragma: no cover
+            pass
+
+    def emit_stats(self, stats, cat, parent):
+        """Write a span per :class:`~chut.Stats`"""
+        for stage in stats:
+            if stage.ended is None:  # pragma: no cover
+                continue
+            self.emit(stage.command, cat, stage.started, stage.ended,
+                      parent=parent, tid=getattr(stage.process, 'pid', None),
+                      spawn=stage.spawn, user=stage.user, sys=stage.sys,
+                      maxrss=stage.maxrss, read=stage.read,
+                      written=stage.written, returncode=stage.returncode)
+
+
+class Reader(object):
+    """Read the stdout of a pipe and the stderr of all its processes at the
+    same time so that no process blocks on a full pipe. Iterate over it to get
+    the chunks of stdout. Captured data is truncated to ``max_stdout`` /
+    ``max_stderr`` bytes per stream but the streams are always drained.
+
+    ``expire`` is called once when no data is read for ``idle_timeout``
+    seconds or after ``timeout`` seconds. Reading goes on until the streams
+    are closed"""
+
+    chunk_size = 65536
+
+    def __init__(self, stdout, stderr, max_stdout=None, max_stderr=None,
+                 timeout=None, idle_timeout=None, expire=None, watch=None):
+        self.stdout = stdout
+        self.stderr = [bytearray() for fd in stderr]
+        self.max_stdout = max_stdout
+        self.max_stderr = max_stderr
+        self.started = self.last = time.time()
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = self.started + timeout
+        self.idle_timeout = idle_timeout
+        self.expire = expire
+        self.expired = False
+        # bytes read per stream (None is stdout). only counted when watched
+        self.watch = watch
+        self.counts = None
+        if watch is not None:
+            self.counts = dict((i, 0) for i in range(len(stderr)))
+            self.counts[None] = 0
+        self.selector = selectors.DefaultSelector()
+        for i, fd in enumerate(stderr):
+            self.selector.register(fd, selectors.EVENT_READ, i)
+
+    def __iter__(self):
+        thread = None
+        if hasattr(self.stdout, 'fileno'):
+            self.selector.register(self.stdout, selectors.EVENT_READ, None)
+            chunks = self._select()
+        elif self.stdout is None:
+            chunks = self._select()
+        else:
+            # stdout is a python iterator. drain stderr in a thread
+            thread = threading.Thread(target=self.drain)
+            thread.daemon = True
+            thread.start()
+            chunks = self.stdout
+        size = 0
+        limit = self.max_stdout
+        counts = self.counts
+        for chunk in chunks:
+            self.last = time.time()
+            if counts is not None and thread is not None:
+                counts[None] += len(chunk)
+            if limit is not None:
+                if size >= limit:
+                    continue
+                chunk = chunk[:limit - size]
+            size += len(chunk)
+            yield chunk
+        if thread is not None:
+            thread.join()
+        self.selector.close()
+
+    def drain(self):
+        for chunk in self._select():
+            pass
+
+    @property
+    def expires(self):
+        """Time of the next expiration or None"""
+        if self.expire is None or self.expired:
+            return None
+        times = [self.deadline]
+        if self.idle_timeout is not None:
+            times.append(self.last + self.idle_timeout)
+        times = [t for t in times if t is not None]
+        return min(times) if times else None
+
+    def _select(self):
+        selector = self.selector
+        limit = self.max_stderr
+        while selector.get_map():
+            timeout = expires = self.expires
+            if expires is not None:
+                timeout = max(0, expires - time.time())
+            ready = selector.select(timeout)
+            if expires is not None and time.time() >= self.expires:
+                self.expired = True
+                self.expire()
+            for key, events in ready:
+                data = os.read(key.fd, self.chunk_size)
+                self.last = time.time()
+                if self.counts is not None:
+                    self.counts[key.data] += len(data)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    if self.watch is not None:
+                        # a closed stream often means that a process exited
+                        self.watch()
+                elif key.data is None:
+                    yield data
+                else:
+                    output = self.stderr[key.data]
+                    if limit is not None:
+                        data = data[:max(0, limit - len(output))]
+                    output += data
+
+
+class AsyncReader(object):
+    """Async iterator over the stdout of a pipe run with asyncio. Yield
+    chunks or decoded lines. The stderr of all processes is drained
+    concurrently. The ``timeout`` and ``idle_timeout`` options of the pipe
+    are honored like in :class:`~chut.Reader`"""
+
+    chunk_size = 65536
+
+    def __init__(self, pipe, lines=False):
+        self.pipe = pipe
+        self.lines = lines
+        self.stdout = self.tasks = None
+        # complete lines and the pieces of the unfinished one
+        self.ready = deque()
+        self.pieces = []
+        self.size = 0
+        self.returncodes = None
+        self.done = self.expired = False
+        self.deadline = self.last = None
+
+    async def iterate(self):
+        """Iterate over the output. The processes are killed if the
+        iteration is closed before the end or cancelled"""
+        try:
+            async for item in self:
+                yield item
+        finally:
+            await self.aclose()
+
+    async def aclose(self):
+        """Kill the processes if the pipe is still running"""
+        if self.tasks is not None and not self.done:
+            self.done = True
+            for task in self.tasks:
+                task.cancel()
+            # the output is not read anymore. a child holding the pipes must
+            # not delay the end of the processes
+            for p in self.pipe.processes:
+                transport = getattr(p, '_transport', None)
+                for fd in (1, 2):
+                    pipe = transport and transport.get_pipe_transport(fd)
+                    if pipe is not None:
+                        pipe.close()
+            await self.kill()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.tasks is None:
+            await self.start()
+        while True:
+            if self.ready:
+                return self.pipe._decode(self.ready.popleft())
+            chunk = await self.read()
+            if not chunk:
+                break
+            if not self.lines:
+                return chunk
+            lines = chunk.split(b'\n')
+            if len(lines) > 1:
+                self.pieces.append(lines[0])
+                self.ready.append(b''.join(self.pieces))
+                self.ready.extend(lines[1:-1])
+                self.pieces = []
+            if lines[-1]:
+                self.pieces.append(lines[-1])
+        if self.pieces:
+            line = b''.join(self.pieces)
+            self.pieces = []
+            return self.pipe._decode(line)
+        await self.finish()
+        raise StopAsyncIteration
+
+    async def start(self):
+        import asyncio
+        pipe = self.pipe
+        self.stdout = await pipe.abg()
+        self.last = time.time()
+        timeout = pipe._option('timeout')
+        if timeout is not None:
+            self.deadline = pipe._started + timeout
+        stats = pipe._stats or [None] * len(pipe.processes)
+        self.tasks = [asyncio.ensure_future(self.drain(p.stderr, stage))
+                      for p, stage in zip(pipe.processes, stats)
+                      if p.stderr]
+
+    def remaining(self):
+        """Seconds before the pipe expires or None"""
+        if self.expired:
+            return None
+        times = [self.deadline]
+        idle_timeout = self.pipe._option('idle_timeout')
+        if idle_timeout is not None:
+            times.append(self.last + idle_timeout)
+        times = [t for t in times if t is not None]
+        if not times:
+            return None
+        return max(0, min(times) - time.time())
+
+    async def timed(self, func):
+        """Await the coroutine returned by ``func``. Kill the pipe when it
+        expires then wait for the end of the coroutine"""
+        import asyncio
+        while True:
+            timeout = self.remaining()
+            if timeout is None:
+                return await func()
+            try:
+                return await asyncio.wait_for(func(), timeout)
+            except asyncio.TimeoutError:
+                if self.remaining() == 0:
+                    await self.expire()
+
+    async def expire(self):
+        """Kill the pipe on timeout. Record the first stage still running"""
+        pipe = self.pipe
+        self.expired = True
+        cmds = [c for c in pipe.commands if not isinstance(c, Stdin)]
+        for cmd, p in zip(cmds, pipe.processes):
+            if self.running(p):
+                pipe._timed_out = cmd._stage_line()
+                break
+        await self.kill()
+
+    def running(self, p):
+        if isinstance(p, Worker):
+            return p.poll() is None
+        return p.returncode is None
+
+    async def wait(self, p):
+        if isinstance(p, Worker):
+            import asyncio
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, p.wait)
+        return await p.wait()
+
+    async def kill(self):
+        """Send TERM to the processes then KILL after ``kill_delay``"""
+        import asyncio
+        import signal
+        pipe = self.pipe
+
+        def send(sig):
+            if pipe._pgid is not None:
+                try:
+                    os.killpg(pipe._pgid, sig)
+                except OSError:
+                    pass
+            for p in pipe.processes:
+                if self.running(p):
+                    try:
+                        p.send_signal(sig)
+                    except OSError:  # pragma: no cover
+                        pass
+
+        send(signal.SIGTERM)
+        waits = asyncio.gather(*[self.wait(p) for p in pipe.processes])
+        # always retrieve the result of the waits
+        waits.add_done_callback(
+            lambda f: f.cancelled() or f.exception())
+        try:
+            await asyncio.wait_for(waits, pipe.kill_delay)
+        except asyncio.TimeoutError:
+            send(signal.SIGKILL)
+        except BaseException:
+            # cancelled or closed while the loop shuts down (an async
+            # generator finalized by asyncio.run). kill without awaiting and
+            # release the pipes before the loop is closed
+            send(signal.SIGKILL)
+            waits.cancel()
+            for p in pipe.processes:
+                transport = getattr(p, '_transport', None)
+                if transport is not None:
+                    transport.close()
+            raise
+
+    async def read(self):
+        limit = self.pipe._option('max_stdout')
+        while True:
+            chunk = b''
+            if self.stdout:
+                chunk = await self.timed(
+                    lambda: self.stdout.read(self.chunk_size))
+                self.last = time.time()
+                if self.pipe._stats:
+                    self.pipe._stats[-1].read += len(chunk)
+            if limit is None or not chunk:
+                return chunk
+            if self.size < limit:
+                chunk = chunk[:limit - self.size]
+                self.size += len(chunk)
+                return chunk
+
+    async def drain(self, stream, stage=None):
+        limit = self.pipe._option('max_stderr')
+        output = bytearray()
+        while True:
+            data = await stream.read(self.chunk_size)
+            self.last = time.time()
+            if stage is not None:
+                stage.read += len(data)
+            if not data:
+                return bytes(output)
+            if limit is not None:
+                data = data[:max(0, limit - len(output))]
+            output += data
+
+    async def finish(self):
+        import asyncio
+        pipe = self.pipe
+        codes = []
+        stats = pipe._stats or [None] * len(pipe.processes)
+        for p, stage in zip(pipe.processes, stats):
+            codes.append(await self.timed(lambda: self.wait(p)))
+            if stage is not None:
+                stage.returncode = codes[-1]
+                stage.ended = time.time()
+        codes = pipe._input_codes() + codes
+        stderr = await asyncio.gather(*self.tasks)
+        self.done = True
+        self.returncodes = [] if set(codes) == set([0]) else codes
+        output = b'\n'.join(stderr).strip()
+        pipe._stderr = output.decode(pipe.encoding, 'ignore')
+        if self.lines:
+            # stdout has been consumed by the iteration
+            pipe._result = pipe._get_stdout('', self.returncodes,
+                                            consumed=True)
+            if pipe._result.failed:
+                pipe._raise(output=pipe._result)
+
+
+class Job(object):
+    """A process started by a :class:`~chut.Batch`"""
+
+    kill_delay = 2
+
+    def __init__(self, index, cmd, process, timeout=None, idle_timeout=None,
+                 pgid=None):
+        self.index = index
+        self.cmd = cmd
+        self.process = process
+        self.pgid = pgid
+        self.started = self.last = time.time()
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = self.started + timeout
+        self.idle_timeout = idle_timeout
+        self.timed_out = False
+        self.kill_at = None
+        self.stats = None
+        self.report = False
+        self.stdout = []
+        self.stderr = []
+        self.outputs = {}
+        self.watched = False
+        self.pidfd = None
+        if hasattr(os, 'pidfd_open'):
+            try:
+                self.pidfd = os.pidfd_open(process.pid)
+            except OSError:  # pragma: no cover
+                pass
+
+    @property
+    def done(self):
+        """True when all pipes are closed and the process exited"""
+        if self.outputs or self.pidfd is not None:
+            return False
+        if self.stats is not None:
+            return self.watched or self.stats.reap(os.WNOHANG)
+        return self.watched or self.process.poll() is not None
+
+    def close(self):
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
+    @property
+    def expires(self):
+        """Next time the job must be checked or None"""
+        if self.kill_at is not None:
+            return self.kill_at
+        if self.timed_out:
+            return None
+        times = [self.deadline]
+        if self.idle_timeout is not None:
+            times.append(self.last + self.idle_timeout)
+        times = [t for t in times if t is not None]
+        return min(times) if times else None
+
+    def signal(self, sig):
+        if self.pgid is not None:
+            try:
+                os.killpg(self.pgid, sig)
+            except OSError:
+                pass
+        if self.process.poll() is None:
+            self.process.send_signal(sig)
+
+    def check(self, now):
+        """Send TERM to an expired job. Then KILL after ``kill_delay``"""
+        import signal
+        expires = self.expires
+        if expires is None or expires > now:
+            return
+        if self.kill_at is not None:
+            self.kill_at = None
+            self.signal(signal.SIGKILL)
+        elif self.process.poll() is None:
+            self.timed_out = True
+            self.kill_at = now + self.kill_delay
+            self.signal(signal.SIGTERM)
+
+    def kill(self):
+        terminate([self.process], self.pgid, self.kill_delay)
+        self.process.wait()
+
+    def result(self):
+        p = self.process
+        if self.stats is not None:
+            self.stats.reap()
+        p.wait()
+        cmd = self.cmd
+        stdout = b''.join(self.stdout).rstrip()
+        stderr = b''.join(self.stderr).strip()
+        return Stdout(cmd._decode(stdout),
+                      stderr=stderr.decode(cmd.encoding, 'ignore'),
+                      returncodes=[p.returncode],
+                      started=self.started, ended=time.time(),
+                      timed_out=cmd.commands_line if self.timed_out else None,
+                      stats=[self.stats] if self.report else None)
+
+
+class Batch(object):
+    """Run a batch of commands with a pool of processes. A selector waits for
+    the output and the exit of children. Output is drained as it arrives and a
+    new job starts as soon as a slot is free. Iterate over it to get the
+    results in order or use :meth:`completed` to get them as they finish.
+
+    ``pipe`` is called with each item of ``args`` to get the command to run.
+    A job running longer than ``timeout`` seconds or without output for
+    ``idle_timeout`` seconds is killed. Jobs run in their own process group
+    when they can be killed so their children are killed too"""
+
+    chunk_size = 65536
+    name = 'map'
+
+    def __init__(self, pipe, args, pool_size, stop_on_failure, kwargs,
+                 timeout=None, idle_timeout=None):
+        self.pipe = pipe
+        self.args = deque(args)
+        self.pool_size = pool_size
+        self.stop_on_failure = stop_on_failure
+        self.launcher = kwargs.pop('launcher', None)
+        self.stats = kwargs.pop('stats', False)
+        self.kwargs = kwargs
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.selector = selectors.DefaultSelector()
+        self.running = set()
+        self.span = None
+
+    def start(self, index, args):
+        if not isinstance(args, list):
+            args = [args]
+        cmd = self.pipe(*args)
+        shell = cmd.kwargs.get('shell', False)
+        args = cmd._spawn_args(shell)
+        kwargs = self.kwargs
+        if not shell and 'executable' not in kwargs:
+            environ = kwargs.get('env', os.environ)
+            executable = resolve(args[0], environ.get('PATH', os.defpath))
+            if executable:
+                kwargs = dict(kwargs, executable=executable)
+        launcher = self.launcher or cmd.kwargs.get('launcher', cmd.launcher)
+        grouped = self.stop_on_failure or self.timeout is not None or \
+            self.idle_timeout is not None
+        if grouped:
+            kwargs = process_group(dict(kwargs), 0)
+        stats = None
+        report = bool(self.stats or cmd.kwargs.get('stats'))
+        if report or self.span is not None:
+            stats = Stats(cmd._stage_line())
+        p = launch(args, kwargs, launcher)
+        job = Job(index, cmd, p, self.timeout, self.idle_timeout,
+                  pgid=p.pid if grouped else None)
+        if stats is not None:
+            stats.spawned(p)
+            job.stats = stats
+            job.report = report
+        p = job.process
+        for name in ('stdout', 'stderr'):
+            fd = getattr(p, name)
+            if fd is not None:
+                job.outputs[fd] = getattr(job, name)
+                self.selector.register(fd, selectors.EVENT_READ, job)
+        if job.pidfd is not None:
+            self.selector.register(job.pidfd, selectors.EVENT_READ, job)
+        job.watched = bool(job.outputs or job.pidfd is not None)
+        self.running.add(job)
+
+    def select(self):
+        # only poll if some jobs can not be watched by the selector
+        timeout = None
+        if not all(j.watched for j in self.running):
+            timeout = .05
+        deadlines = [j.expires for j in self.running
+                     if j.expires is not None]
+        if deadlines:
+            delay = max(0, min(deadlines) - time.time())
+            timeout = delay if timeout is None else min(timeout, delay)
+        jobs = set()
+        for key, events in self.selector.select(timeout):
+            job = key.data
+            jobs.add(job)
+            if key.fd == job.pidfd:
+                self.selector.unregister(key.fd)
+                job.close()
+                continue
+            data = os.read(key.fd, self.chunk_size)
+            if data:
+                job.outputs[key.fileobj].append(data)
+                job.last = time.time()
+                if job.stats is not None:
+                    job.stats.read += len(data)
+            else:
+                self.selector.unregister(key.fileobj)
+                del job.outputs[key.fileobj]
+        if timeout is not None:
+            jobs.update(self.running)
+        now = time.time()
+        for job in self.running:
+            job.check(now)
+        return [j for j in jobs if j.done]
+
+    def kill(self):
+        for job in self.running:
+            job.kill()
+
+    def __iter__(self):
+        results = {}
+        out_index = 0
+        for index, output in self.completed():
+            results[index] = output
+            while out_index in results:
+                yield results.pop(out_index)
+                out_index += 1
+
+    def completed(self):
+        """Yield ``(index, result)`` as soon as a job finish"""
+        index = 0
+        if trace.active:
+            self.span = trace.new_id(), trace.current, time.time()
+        try:
+            while self.args or self.running:
+                while self.args and len(self.running) < self.pool_size:
+                    self.start(index, self.args.popleft())
+                    index += 1
+                failed = None
+                for job in self.select():
+                    self.running.remove(job)
+                    output = job.result()
+                    if self.span is not None:
+                        cat = 'ssh' if isinstance(job.cmd._chut, SSH) \
+                            else 'job'
+                        trace.emit_stats([job.stats], cat, self.span[0])
+                    if output.failed and self.stop_on_failure:
+                        failed = job, output
+                    else:
+                        yield job.index, output
+                if failed is not None:
+                    self.args.clear()
+                    self.kill()
+                    job, output = failed
+                    job.cmd._raise(output=output)
+        finally:
+            if self.running and sys.exc_info()[0] is not None:
+                # cancelled (KeyboardInterrupt, ...)
+                self.kill()
+            for job in self.running:
+                job.close()
+            self.selector.close()
+            if self.span is not None:
+                id, parent, started = self.span
+                trace.emit(self.name, 'map', started, time.time(), id, parent,
+                           jobs=index, pool_size=self.pool_size)
+
+
+class Worker(object):
+    """Run the function of a :class:`~chut.PyPipe` in a thread or in a forked
+    process (depending on the ``backend`` of the pipe). Read from ``stdin``
+    and write to the ``fd`` file descriptor. Behave like a Popen object"""
+
+    stdout = stderr = None
+
+    def __init__(self, pipe, stdin, fd, owned=True, pgid=None, stats=None,
+                 source=None):
+        self.pipe = pipe
+        self.stats = stats
+        self.source = source
+        self.returncode = None
+        self.thread = None
+        if pipe.backend == 'process':
+            self.pid = os.fork()
+            if self.pid == 0:  # pragma: no cover
+                if pgid is not None:
+                    os.setpgid(0, pgid)
+                self.child(stdin, fd)
+            if pgid is not None:
+                # also set in the parent. the child may not be running yet
+                try:
+                    os.setpgid(self.pid, pgid or self.pid)
+                except OSError:  # pragma: no cover
+                    pass
+            os.close(fd)
+            if owned:
+                stdin.close()
+        else:
+            self.pid = None
+            self.thread = threading.Thread(target=self.run,
+                                           args=(stdin, fd, owned))
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self, stdin, fd, owned):
+        pipe = self.pipe
+        pipe.stdin = stdin
+        try:
+            feed(fd, pipe.iter_stdout, pipe.encoding, self.stats, self.source)
+        except Exception:
+            log.exception('%s() failed', pipe.__class__.__name__)
+            self.returncode = 1
+        else:
+            self.returncode = 0
+        finally:
+            if owned:
+                stdin.close()
+
+    def child(self, stdin, fd):  # pragma: no cover
+        # do not keep other pipes open
+        keep = sorted([stdin.fileno(), fd])
+        start = 3
+        for i in keep:
+            if i >= start:
+                os.closerange(start, i)
+                start = i + 1
+        os.closerange(start, os.sysconf('SC_OPEN_MAX'))
+        code = 0
+        try:
+            self.pipe.stdin = stdin
+            feed(fd, self.pipe.iter_stdout, self.pipe.encoding)
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            code = 1
+        os._exit(code)
+
+    def _status(self, flags):
+        pid, status = os.waitpid(self.pid, flags)
+        if pid == self.pid:
+            if os.WIFSIGNALED(status):
+                self.returncode = -os.WTERMSIG(status)
+            else:
+                self.returncode = os.WEXITSTATUS(status)
+        return self.returncode
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+        elif self.returncode is None:
+            self._status(0)
+        return self.returncode
+
+    def poll(self):
+        if self.pid is not None and self.returncode is None:
+            self._status(os.WNOHANG)
+        return self.returncode
+
+    def send_signal(self, signum):
+        if self.pid is not None and self.returncode is None:
+            os.kill(self.pid, signum)
+
+    def kill(self):
+        self.send_signal(9)
+
 
 class PyPipe(Pipe):
+    """A python function used in a pipe. Use :meth:`chut.Chut.wraps`"""
+
+    backend = 'thread'
 
     @property
     def iter_stdout(self):
         return self.func(self.stdin)
 
     def __deepcopy__(self, *args):
-        return sh.wraps(self.func)
+        return sh.wraps(self.func, backend=self.backend)
+
+
+def call(func, item):
+    """Call func(item). Return a (succeeded, result or exception) tuple"""
+    try:
+        return True, func(item)
+    except Exception as e:
+        return False, e
+
+
+def call_pypipe(func, encoding, value):
+    """Run the function of a :class:`~chut.PyPipe` with value as stdin.
+    Return a :class:`~chut.Stdout`"""
+    if isinstance(value, str):
+        value = value.encode(encoding)
+    if isinstance(value, (bytes, bytearray)):
+        value = io.BytesIO(value)
+    output = [chunk.encode(encoding) if isinstance(chunk, str) else chunk
+              for chunk in func(value)]
+    return Stdout(b''.join(output).rstrip().decode(encoding))
+
+
+_worker_func = None  # function used by the processes of Chut.map()
+
+
+def init_worker(func):
+    global _worker_func
+    _worker_func = func
+
+
+def call_worker(item):
+    return call(_worker_func, item)
 
 
 class Base(object):
@@ -700,8 +2630,52 @@ class Chut(Base):
 
     path = Path()
 
-    def wraps(self, func):
-        return type(func.__name__, (PyPipe,), {'func': staticmethod(func)})()
+    def wraps(self, func=None, backend='thread'):
+        """Use a python function in a pipe. The function take an iterator over
+        stdin and yield some output. When the function is not the last
+        command of the pipe it runs concurrently in a thread or in a forked
+        process if ``backend`` is ``'process'``"""
+        if func is None:
+            return functools.partial(self.wraps, backend=backend)
+        attrs = {'func': staticmethod(func), 'backend': backend}
+        return type(func.__name__, (PyPipe,), attrs)()
+
+    def map(self, func, iterable, pool_size=None, stop_on_failure=False,
+            backend='process', chunk_size=None):
+        """Run a python callable or a :class:`~chut.PyPipe` on each item of
+        iterable using a pool of processes (or threads if ``backend`` is
+        ``'thread'``). Items are sent to the workers by chunks of
+        ``chunk_size``. Yield results in order. A :class:`~chut.PyPipe` take
+        each item as stdin and return a :class:`~chut.Stdout`.
+
+        Exceptions are yielded in place of results. The first one is raised
+        if ``stop_on_failure`` is true"""
+        import multiprocessing
+        from multiprocessing.pool import ThreadPool
+        if isinstance(func, PyPipe):
+            func = functools.partial(call_pypipe, func.func, func.encoding)
+        if pool_size is None:
+            pool_size = multiprocessing.cpu_count()
+        if backend == 'thread':
+            pool = ThreadPool(pool_size)
+            task = functools.partial(call, func)
+            chunk_size = chunk_size or 1
+        else:
+            # workers are forked so func does not need to be pickled
+            ctx = multiprocessing.get_context('fork')
+            pool = ctx.Pool(pool_size, init_worker, (func,))
+            task = call_worker
+            if chunk_size is None:
+                size = len(iterable) if hasattr(iterable, '__len__') else 0
+                chunk_size = max(1, size // (pool_size * 4))
+        try:
+            for succeeded, result in pool.imap(task, iterable, chunk_size):
+                if not succeeded and stop_on_failure:
+                    raise result
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
 
     @contextmanager
     def pipes(self, cmd):
@@ -725,11 +2699,19 @@ class Chut(Base):
         """return os.path.abspath(os.getcwd())"""
         return os.path.abspath(os.getcwd())
 
-    def stdin(self, value):
-        return Stdin(value)
+    def stdin(self, value, encoding=None):
+        return Stdin(value, encoding=encoding)
+
+    def ssh(self, *args, **options):
+        """Return a :class:`~chut.SSH` server. ``options`` can contain
+        ``multiplex`` and ``persist``"""
+        return SSH('ssh', *args, **options)
 
-    def ssh(self, *args):
-        return SSH('ssh', *args)
+    def ssh_group(self, hosts, pool_size=None, timeout=None, **options):
+        """Return a :class:`~chut.SSHGroup` to run a command on all
+        ``hosts`` at once"""
+        return SSHGroup(hosts, pool_size=pool_size, timeout=timeout,
+                        **options)
 
 
 class ChangeDir:
@@ -766,7 +2748,107 @@ class Command(Base):
 
 
 class SSH(Base):
-    """A ssh server"""
+    """A ssh server. Commands share one authenticated connection (ssh's
+    ControlMaster) unless ``multiplex`` is false. The master connection stay
+    alive ``persist`` seconds after the last command. It can also be closed
+    when the last ``with`` block using the server exit::
+
+        with sh.ssh('host') as srv:
+            srv.ls()
+    """
+
+    multiplex = True
+    persist = 60
+    control_dir = None
+    _refs = {}
+    _warned = False
+
+    def __init__(self, name, *cmd_args, **options):
+        super(SSH, self).__init__(name, *cmd_args)
+        self.options = options
+        for k, v in options.items():
+            setattr(self, k, v)
+
+    @property
+    def control_path(self):
+        """The path of the master socket. It is stored in
+        ``$XDG_RUNTIME_DIR/chut-ssh`` (or ``~/.ssh/chut``) unless
+        ``control_dir`` is set. The directory must belong to the current user
+        and have a 0700 mode. None if the default directory can not be
+        created. Commands are then not multiplexed"""
+        import hashlib
+        import stat
+        dirname = self.control_dir
+        if dirname is None:
+            runtime = os.environ.get('XDG_RUNTIME_DIR')
+            if runtime:
+                dirname, names = runtime, ['chut-ssh']
+            else:
+                dirname, names = os.path.expanduser('~'), ['.ssh', 'chut']
+            try:
+                # never create $XDG_RUNTIME_DIR or $HOME
+                if not os.path.isdir(dirname):
+                    raise FileNotFoundError(
+                        errno.ENOENT, 'No such directory', dirname)
+                for name in names:
+                    dirname = os.path.join(dirname, name)
+                    try:
+                        os.mkdir(dirname, 0o700)
+                    except FileExistsError:
+                        pass
+            except OSError as e:
+                if not SSH._warned:
+                    SSH._warned = True
+                    log.warning('ssh multiplexing disabled: %s', e)
+                return None
+        else:
+            os.makedirs(dirname, mode=0o700, exist_ok=True)
+        st = os.lstat(dirname)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+           stat.S_IMODE(st.st_mode) != 0o700:
+            raise PermissionError(
+                errno.EPERM, 'Unsafe directory for ssh sockets', dirname)
+        key = ' '.join(self._cmd_args[1:]).encode('utf8')
+        return os.path.join(dirname, hashlib.sha1(key).hexdigest()[:16])
+
+    def spawn_args(self, args):
+        """Add the alias of ssh and the multiplexing options to args"""
+        options = []
+        path = self.multiplex and self.control_path
+        if path:
+            options = ['-o', 'ControlMaster=auto',
+                       '-o', 'ControlPath=%s' % path,
+                       '-o', 'ControlPersist=%s' % self.persist]
+        return aliases.get('ssh', 'ssh').split() + options + args[1:]
+
+    def __enter__(self):
+        path = self.multiplex and self.control_path
+        if path:
+            self._refs[path] = self._refs.get(path, 0) + 1
+        return self
+
+    def __exit__(self, *args):
+        if self.multiplex:
+            self.close()
+
+    def close(self):
+        """Release the master connection. It is closed when no ``with`` block
+        use it anymore"""
+        path = self.control_path
+        if path is None:
+            return
+        refs = self._refs.get(path, 0) - 1
+        if refs > 0:
+            self._refs[path] = refs
+            return
+        self._refs.pop(path, None)
+        if os.path.exists(path):
+            args = aliases.get('ssh', 'ssh').split() + [
+                '-o', 'ControlPath=%s' % path, '-O', 'exit'
+            ] + self._cmd_args[1:]
+            log.debug('Popen(%r)', args)
+            Popen(args, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+                  env=env).wait()
 
     def join(self, *args):
         p = posixpath.join(*args)
@@ -797,8 +2879,71 @@ class SSH(Base):
                 cmds.append(a.commands_line)
             else:
                 cmds.append(a)
-        srv = getattr(SSH(aliases.get('ssh'), *self._cmd_args[1:]), '')
-        return srv(*cmds, **kwargs)
+        srv = SSH('ssh', *self._cmd_args[1:], **self.options)
+        return getattr(srv, '')(*cmds, **kwargs)
+
+
+class SSHGroup(object):
+    """Run the same command on a group of hosts. Up to ``pool_size`` ssh
+    processes run at the same time. A host which does not answer in
+    ``timeout`` seconds or stays silent for ``idle_timeout`` seconds is
+    killed. ``options`` are passed to :class:`~chut.SSH`::
+
+        group = sh.ssh_group(['srv1', 'srv2'], timeout=10)
+        for host, output in group('uptime'):
+            print(host, output)
+        print(group.summary())
+    """
+
+    pool_size = 20
+
+    def __init__(self, hosts, pool_size=None, timeout=None,
+                 idle_timeout=None, **options):
+        self.hosts = list(hosts)
+        if pool_size is not None:
+            self.pool_size = pool_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.options = options
+        self.results = {}
+
+    def __call__(self, *args, **kwargs):
+        """Run the command (a string or a :class:`~chut.Pipe`) on all hosts.
+        Yield ``(host, output)`` as soon as a host is done"""
+        self.results = {}
+        kw = dict(stdin=DEVNULL, stdout=PIPE, stderr=PIPE, env=env)
+        kw.update(kwargs)
+
+        def command(host):
+            return SSH('ssh', host, **self.options)(*args)
+
+        batch = Batch(command, self.hosts, self.pool_size, False, kw,
+                      timeout=self.timeout, idle_timeout=self.idle_timeout)
+        batch.name = 'ssh_group'
+
+        for index, output in batch.completed():
+            host = self.hosts[index]
+            self.results[host] = output
+            yield host, output
+
+    @property
+    def failures(self):
+        """Failed hosts and their output from the last run"""
+        return dict((h, o) for h, o in self.results.items() if o.failed)
+
+    def summary(self):
+        """A summary of the last run"""
+        failures = self.failures
+        lines = ['%s hosts, %s failed' % (len(self.results), len(failures))]
+        for host in self.hosts:
+            if host in failures:
+                output = failures[host]
+                stderr = output.stderr.strip().split('\n')[-1]
+                if output.timed_out:
+                    stderr = ' '.join(s for s in (stderr, 'timed out') if s)
+                lines.append('%s: %s %s' % (
+                    host, output.returncodes[-1], stderr))
+        return '\n'.join(lines)
 
 
 class ModuleWrapper(types.ModuleType):
@@ -822,10 +2967,12 @@ class ModuleWrapper(types.ModuleType):
                 return [str(c) for c in __all__]
             else:  # pragma: no cover
                 raise ImportError('You cant import things that does not exist')
-        if getattr(self.mod, attr, None) is not None:
-            return getattr(self.mod, attr)
-        else:
-            return getattr(self.chut, attr)
+        value = getattr(self.mod, attr, None)
+        if value is None:
+            value = getattr(self.chut, attr)
+        # next lookups will not reach __getattr__
+        self.__dict__[attr] = value
+        return value
 
     __getitem__ = __getattr__
 
@@ -838,6 +2985,9 @@ warn = logopts.log('warn')
 exc = logopts.log('exception')
 
 env = Environ(os.environ.copy())
+trace = Tracer()
+if os.environ.get('CHUT_TRACE'):
+    trace.start(os.environ['CHUT_TRACE'], append=True)
 sh = Chut('sh')
 sudo = Chut('sudo', '-s')
 test = Command('test')
@@ -879,21 +3029,73 @@ def requires(*requirements, **kwargs):
         info('Installing %s...' % ', '.join(requirements))
         sh.pip('install -qM', *requirements) > 1
     elif env.chut_virtualenv:
-        upgrade = '--upgrade' in sys.argv
-        if (env.chut_upgrade or upgrade):  # pragma: no cover
-            installed = ''
-        else:
-            installed = str(sh.pip('freeze')).lower()
-        requirements = [r for r in requirements if r.lower() not in installed]
-        if requirements:  # pragma: no cover
-            info('Updating %s...' % ', '.join(requirements))
-            sh.pip('install -qM --upgrade', *requirements) > 1
+        upgrade = env.chut_upgrade or '--upgrade' in sys.argv
+        stamp = os.path.join(venv, '.chut-requires')
+        try:
+            with open(stamp) as fd:
+                satisfied = fd.read() == requirements_stamp(requirements)
+        except OSError:
+            satisfied = False
+        if upgrade or not satisfied:
+            missing = requirements
+            if not upgrade:
+                missing = missing_requirements(requirements)
+            if missing:  # pragma: no cover
+                info('Updating %s...' % ', '.join(missing))
+                sh.pip('install -qM --upgrade', *missing) > 1
+            try:
+                with open(stamp, 'w') as fd:
+                    fd.write(requirements_stamp(requirements))
+            except OSError:  # pragma: no cover
+                pass
     executable = os.path.join(bin_dir, 'python')
     if not env.chut_virtualenv:  # pragma: no cover
         env.chut_virtualenv = venv
         os.execve(executable, [executable] + sys.argv, env)
 
 
+def requirements_stamp(requirements):
+    """A hash of the requirements and of the mtimes of the site-packages
+    directories. It change when something is installed"""
+    import hashlib
+    h = hashlib.sha256(repr(sorted(requirements)).encode('utf8'))
+    for dirname in sys.path:
+        if dirname.endswith('-packages') and os.path.isdir(dirname):
+            h.update(('%s:%s' % (dirname, _mtime(dirname))).encode('utf8'))
+    return h.hexdigest()
+
+
+def missing_requirements(requirements):
+    """Return the requirements which are not satisfied by the installed
+    distributions. Requirements which can not be parsed (urls, vcs or local
+    paths) are always missing"""
+    try:
+        from importlib import metadata
+    except ImportError:  # pragma: no cover
+        import importlib_metadata as metadata
+    try:
+        from packaging.requirements import InvalidRequirement
+        from packaging.requirements import Requirement
+    except ImportError:  # pragma: no cover
+        from pip._vendor.packaging.requirements import InvalidRequirement
+        from pip._vendor.packaging.requirements import Requirement
+    missing = []
+    for requirement in requirements:
+        try:
+            req = Requirement(requirement)
+        except InvalidRequirement:
+            missing.append(requirement)
+            continue
+        try:
+            version = metadata.version(req.name)
+        except metadata.PackageNotFoundError:
+            missing.append(requirement)
+        else:
+            if not req.specifier.contains(version, prereleases=True):
+                missing.append(requirement)
+    return missing
+
+
 class console_script(object):
     """A decorator to take care of sys.argv via docopt"""
 
@@ -1003,73 +3205,134 @@ class Generator(object):
         self.dest = dest
         args.update(version=repr(str(args.get('--version') or 'unknown')),
                     interpreter=args.get('--interpreter', 'python3'))
+        self.format = args.get('--format') or args.get('format') or 'source'
+        if self.format not in self.formats:
+            raise ValueError('Invalid format %r' % self.format)
         self.args = args
-        self.mods = self.encode_modules(*args.get('modules', []))
-
-    def encode_module(self, mod):
-        if not hasattr(mod, '__file__'):
-            mod = __import__(mod)
-        name = str(mod.__name__)
-        if name not in self._modules:
-            data = inspect.getsource(mod)
-            data = base64.encodebytes(zlib.compress(data.encode('utf8')))
-            code = '_chut_modules.append((%r, %r))\n' % (name, data)
-            self._modules[name] = code
-        return self._modules[name]
-
-    def encode_modules(self, *modules):
+        self.sources = self.get_sources(*args.get('modules', []))
+        self.cache_file = args.get('cache_file') or os.path.join(
+            env.xdg_cache_home or os.path.expanduser('~/.cache'),
+            'chut', 'builds.json')
+        self._mods = self._key = None
+
+    @property
+    def mods(self):
+        """The embedded modules. Encoded on first use"""
+        if self._mods is None:
+            if self.format == 'zipapp':
+                self._mods = ''
+                for name, source in self.sources:
+                    self.compile(name, source)
+            else:
+                self._mods = '_chut_modules = []\n' + ''.join(
+                    [self.encode_module(n, s) for n, s in self.sources])
+        return self._mods
+
+    formats = ('source', 'bytecode', 'zipapp')
+
+    def get_sources(self, *modules):
+        """Return a list of ``(name, source)`` of modules to embed"""
         try:
             # check if the script is already chutified
             _chut_modules = sys.modules['__main__']._chut_modules
         except AttributeError:
             # get source from files
+            import inspect
+            sources = []
             modules = [
                 'docopt', 'ConfigObject',
                 sys.modules[__name__]
             ] + list(modules)
-            modules = ''.join([self.encode_module(m) for m in modules])
+            for mod in modules:
+                if not hasattr(mod, '__file__'):
+                    mod = __import__(mod)
+                sources.append((str(mod.__name__), inspect.getsource(mod)))
+            return sources
         else:  # pragma: no cover
             # get source from _chut_modules
-            modules = ''
-            for name, data in _chut_modules:
-                modules += '_chut_modules.append((%r, %r))\n' % (name, data)
-        return modules
+            import base64
+            import zlib
+            sources = []
+            for item in _chut_modules:
+                data = zlib.decompress(base64.decodebytes(item[1].encode()))
+                sources.append((item[0], data.decode('utf8')))
+            return sources
+
+    def compile(self, name, source):
+        """Compile source with the interpreter of the scripts. Return its
+        cache tag and the content of a .pyc file"""
+        key = (name, source, self.args['interpreter'])
+        if key not in self._modules:
+            interpreter = resolve(self.args['interpreter']) or sys.executable
+            filename = '<%s>' % name
+            if os.path.realpath(interpreter) == \
+               os.path.realpath(sys.executable):
+                self._modules[key] = pyc(source.encode('utf8'), filename)
+            else:
+                import inspect
+                code = inspect.getsource(pyc) + COMPILE_PYC
+                output = b''.join((sh.stdin(source.encode('utf8')) | sh.pipe(
+                    interpreter, ['-c', code, filename])).iter_bytes())
+                tag, data = output.split(b'\n', 1)
+                self._modules[key] = tag.decode('ascii'), data
+        return self._modules[key]
+
+    def encode_module(self, name, source):
+        import base64
+        import zlib
+        key = (name, source, self.format, self.args['interpreter'])
+        if key not in self._modules:
+            data = base64.encodebytes(zlib.compress(source.encode('utf8')))
+            args = (name, data.decode('ascii'))
+            if self.format == 'bytecode':
+                tag, code = self.compile(name, source)
+                # strip the header of the .pyc
+                code = base64.encodebytes(zlib.compress(code[16:]))
+                args += (tag, code.decode('ascii'))
+            self._modules[key] = '_chut_modules.append(%r)\n' % (args,)
+        return self._modules[key]
+
+    def zipapp(self, script, main):
+        """Write an executable zip containing ``__main__.py`` and the .pyc of
+        the embedded modules. The sources are kept for other interpreters"""
+        import zipfile
+        with open(script, 'wb') as fd:
+            fd.write(('#!/usr/bin/env %(interpreter)s\n' %
+                      self.args).encode('utf8'))
+            with zipfile.ZipFile(fd, 'w', zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr('__main__.py', main)
+                for name, source in self.sources:
+                    zf.writestr(name + '.py', source)
+                    zf.writestr(name + '.pyc', self.compile(name, source)[1])
 
     def generate(self, filename, args=None, **kwargs):
         if args is None:
             args = {}
         args.update(kwargs)
         dirname = os.path.dirname(filename)
-        mod_name = inspect.getmodulename(filename)
+        mod_name = os.path.splitext(os.path.basename(filename))[0]
         os.environ.update(env)
 
-        console_scripts = list(sh.grep('-A4 -E @.*console_script', filename))
-        console_scripts = [s for s in console_scripts if s.startswith('def ')]
-
         scripts = []
-        loop = '--loop' in sys.argv or '-l' in sys.argv
         while not os.path.isfile(filename):  # pragma: no cover
             time.sleep(.1)
-        mtime = os.stat(filename)[stat.ST_MTIME]
-        if console_scripts and self.version:
-            version = sh.grep('-E ^__version__', filename)
-            if version:
-                version = str(version).split('=')[1].strip('\'" ')
-                if version != self.version:
-                    info('bump %s version from %s to %s',
-                         posixpath.basename(filename), version, self.version)
-                    sh.sed((
-                        '-i \'s/^__version__ =.*/__version__ = "%s"/\''
-                    ) % self.version, filename, shell=True) > 1
-        for func_name in sorted(set(console_scripts)):
-            name = func_name[4:].split('(')[0]
+        console_scripts, version = self.parse(filename)
+        if console_scripts and self.version and version is not None:
+            if version != self.version:
+                info('bump %s version from %s to %s',
+                     posixpath.basename(filename), version, self.version)
+                with open(filename) as fd:
+                    data = fd.read()
+                data = re.sub(r'(?m)^__version__ =.*$',
+                              '__version__ = "%s"' % self.version, data)
+                with open(filename, 'w') as fd:
+                    fd.write(data)
+        for name in sorted(set(console_scripts)):
             script = os.path.join(self.dest, name.replace('_', '-'))
-            if os.path.isfile(script) and loop:  # pragma: no cover
-                smtime = os.stat(script)[stat.ST_MTIME]
-                if mtime <= smtime:
-                    continue
-            with open(script, 'w') as fd:
-                fd.write(SCRIPT_HEADER % self.args + self.mods + LOAD_MODULES)
+            with io.StringIO() as fd:
+                fd.write(SCRIPT_HEADER % self.args)
+                if self.format != 'zipapp':
+                    fd.write(self.mods + LOAD_MODULES)
                 if self.devel:
                     fd.write('sys.path.insert(0, "%s")\n' % dirname)
                     fd.write('import %s\n' % mod_name)
@@ -1084,6 +3347,11 @@ class Generator(object):
                         fd.write((
                             "\nif __name__ == '__main__':\n    %s()\n"
                         ) % name)
+                if self.format == 'zipapp':
+                    self.zipapp(script, fd.getvalue())
+                else:
+                    with open(script, 'w') as output:
+                        output.write(fd.getvalue())
             executable = sh.chmod('+x', script)
             if executable:
                 info(executable.commands_line)
@@ -1092,17 +3360,395 @@ class Generator(object):
                 error('failed to generate %s' % script)
         return scripts
 
-    def __call__(self, location):
+    @property
+    def key(self):
+        """A hash of the embedded modules and of the options"""
+        if self._key is None:
+            import hashlib
+            h = hashlib.sha256()
+            for name, source in self.sources:
+                h.update(name.encode('utf8') + b'\0' + source.encode('utf8'))
+            options = (self.format, self.devel, self.version,
+                       self.args['version'], self.args['interpreter'])
+            h.update(repr(options).encode('utf8'))
+            self._key = h.hexdigest()
+        return self._key
+
+    def digest(self, filename):
+        import hashlib
+        with open(filename, 'rb') as fd:
+            data = fd.read()
+        return hashlib.sha256(self.key.encode('ascii') + data).hexdigest()
+
+    def load_cache(self):
+        import json
+        try:
+            with open(self.cache_file) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+    def save_cache(self, cache):
+        import json
+        dirname = os.path.dirname(self.cache_file)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        tmp = '%s.%s' % (self.cache_file, os.getpid())
+        with open(tmp, 'w') as fd:
+            json.dump(cache, fd)
+        os.rename(tmp, self.cache_file)
+
+    def cache_key(self, filename):
+        return ':'.join([os.path.abspath(filename),
+                         os.path.abspath(self.dest)])
+
+    def up_to_date(self, entry, filename):
+        """Return the scripts generated from filename if the source, the
+        options and the scripts did not change since the last build"""
+        if not entry or entry['digest'] != self.digest(filename):
+            return None
+        for script, (mtime, size) in entry['scripts'].items():
+            try:
+                st = os.stat(script)
+            except OSError:
+                return None
+            if [st.st_mtime_ns, st.st_size] != [mtime, size]:
+                return None
+        return sorted(entry['scripts'])
+
+    def build(self, filenames, pool_size=None):
+        """Generate scripts from all filenames. Files are skipped when their
+        build is up to date. Others are generated with a pool of processes"""
+        cache = self.load_cache()
         scripts = []
+        todo = []
+        for filename in filenames:
+            key = self.cache_key(filename)
+            done = self.up_to_date(cache.get(key), filename)
+            if done is None:
+                todo.append(filename)
+            else:
+                scripts.extend(done)
+        if not todo:
+            return sorted(scripts)
+        self.mods  # encode modules before forking
+
+        def generate(filename):
+            with trace.span(filename, 'generator'):
+                return self.generate(filename)
+
+        with trace.span('build', 'generator', files=len(todo)):
+            if len(todo) > 1:
+                results = list(sh.map(generate, todo, pool_size=pool_size,
+                                      stop_on_failure=True))
+            else:
+                results = [generate(todo[0])]
+        for filename, generated in zip(todo, results):
+            scripts.extend(generated)
+            stats = dict((s, os.stat(s)) for s in generated)
+            cache[self.cache_key(filename)] = dict(
+                digest=self.digest(filename),
+                scripts=dict((s, [st.st_mtime_ns, st.st_size])
+                             for s, st in stats.items()))
+        self.save_cache(cache)
+        return sorted(scripts)
+
+    _parsed = {}
+    pruned = ('__pycache__', 'site-packages')
+
+    def parse(self, filename):
+        """Return the names of the functions decorated by
+        :func:`~chut.console_script` and the ``__version__`` of a python file.
+        Results are cached until the file change"""
+        st = os.stat(filename)
+        path = os.path.abspath(filename)
+        key = (st.st_mtime_ns, st.st_size)
+        cached = self._parsed.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        with open(filename, 'rb') as fd:
+            source = fd.read()
+        scripts = []
+        version = None
+        if b'console_script' in source:
+            import ast
+            import warnings
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    tree = ast.parse(source, filename)
+            except (SyntaxError, ValueError):
+                log.warning('Not able to parse %s', filename)
+                tree = ast.Module(body=[])
+            for node in tree.body:
+                if isinstance(node, ast.FunctionDef):
+                    for d in node.decorator_list:
+                        if isinstance(d, ast.Call):
+                            d = d.func
+                        if getattr(d, 'id', getattr(d, 'attr', None)) == \
+                           'console_script':
+                            scripts.append(node.name)
+                elif isinstance(node, ast.Assign) and [
+                        getattr(t, 'id', None) for t in node.targets
+                ] == ['__version__']:
+                    try:
+                        version = str(ast.literal_eval(node.value))
+                    except ValueError:
+                        pass
+        self._parsed[path] = key, (scripts, version)
+        return scripts, version
+
+    def __call__(self, location):
+        filenames = []
         if os.path.isfile(location):
-            scripts.extend(self.generate(location))
+            filenames.append(location)
         elif os.path.isdir(location):
-            filenames = sh.grep('-lRE --include=*.py @.*console_script',
-                                location) | sh.grep('-v site-packages')
-            for filename in sorted(filenames):
-                scripts.extend(self.generate(filename))
-        return scripts
+            for path, is_dir in walk(location, self.pruned):
+                if not is_dir and path.endswith('.py') and \
+                   self.parse(path)[0]:
+                    filenames.append(path)
+            filenames = sorted(filenames)
+        return self.build(filenames)
+
+
+def walk(dirname, pruned=(), recursive=True):
+    """Yield ``(path, is_dir)`` for all entries under dirname. Hidden and
+    ``pruned`` directories are skipped"""
+    try:
+        entries = list(os.scandir(dirname))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name.startswith('.') or entry.name in pruned:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            yield entry.path, True
+            if recursive:
+                for item in walk(entry.path, pruned):
+                    yield item
+        else:
+            yield entry.path, False
+
 
+class Watcher(object):
+    """Watch the python files of a directory (or a single file). Iterate over
+    it to get the sets of modified files. Changes are merged until nothing
+    happen for ``delay`` seconds. Use inotify when available so that waiting
+    cost nothing. Else the mtimes of the files are checked every ``interval``
+    seconds"""
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    suffix = '.py'
+    pruned = ('__pycache__', 'site-packages')
+
+    def __init__(self, location, delay=.2, interval=1, inotify=True):
+        location = os.path.abspath(location)
+        self.filename = None
+        if os.path.isfile(location):
+            self.filename = location
+            location = os.path.dirname(location)
+        self.location = location
+        self.delay = delay
+        self.interval = interval
+        self.fd = None
+        self.watches = {}
+        if inotify:
+            self.fd = self.inotify()
+        if self.fd is None:
+            self.mtimes = self.snapshot()
+        else:
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.fd, selectors.EVENT_READ)
+            self.add_tree(location)
+
+    def inotify(self):
+        import ctypes
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            init = libc.inotify_init1
+        except (OSError, AttributeError):  # pragma: no cover
+            return None
+        self.add_watch = libc.inotify_add_watch
+        self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                   ctypes.c_uint32]
+        fd = init(os.O_CLOEXEC | os.O_NONBLOCK)
+        return fd if fd >= 0 else None
+
+    def match(self, path):
+        if self.filename is not None:
+            return path == self.filename
+        # skip hidden files like editor locks (.#a.py)
+        return path.endswith(self.suffix) and \
+            not os.path.basename(path).startswith('.')
+
+    def walk(self, dirname):
+        return walk(dirname, self.pruned, recursive=self.filename is None)
+
+    def add_tree(self, dirname):
+        """Watch dirname and its sub directories. Return the files found"""
+        files = set()
+        wd = self.add_watch(self.fd, os.fsencode(dirname), self.mask)
+        if wd >= 0:
+            self.watches[wd] = dirname
+        for path, is_dir in self.walk(dirname):
+            if is_dir:
+                if self.filename is None:
+                    wd = self.add_watch(self.fd, os.fsencode(path), self.mask)
+                    if wd >= 0:
+                        self.watches[wd] = path
+            elif self.match(path):
+                files.add(path)
+        return files
+
+    def snapshot(self):
+        mtimes = {}
+        for path, is_dir in self.walk(self.location):
+            if not is_dir and self.match(path):
+                try:
+                    mtimes[path] = os.stat(path).st_mtime_ns
+                except OSError:  # pragma: no cover
+                    pass
+        return mtimes
+
+    def changes(self, timeout):
+        """Return the files changed in the next ``timeout`` seconds"""
+        if self.fd is None:
+            time.sleep(self.interval if timeout is None
+                       else min(self.interval, timeout))
+            mtimes = self.snapshot()
+            changed = set(p for p, m in mtimes.items()
+                          if self.mtimes.get(p) != m)
+            self.mtimes = mtimes
+            return changed
+        import struct
+        changed = set()
+        if not self.selector.select(timeout):
+            return changed
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, size = struct.unpack_from('iIII', data, offset)
+            offset += 16
+            name = data[offset:offset + size].rstrip(b'\0')
+            offset += size
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+            dirname = self.watches.get(wd)
+            if dirname is None or not name:
+                continue
+            path = os.path.join(dirname, os.fsdecode(name))
+            if mask & self.IN_ISDIR:
+                if self.filename is None and not name.startswith(b'.'):
+                    # files may be written before the watch is added
+                    changed.update(self.add_tree(path))
+            elif self.match(path):
+                changed.add(path)
+        return changed
+
+    def wait(self, timeout=None):
+        """Wait for some changes. Return the set of modified files (empty if
+        nothing changed before ``timeout``)"""
+        end = None if timeout is None else time.time() + timeout
+        changed = set()
+        while not changed:
+            remaining = None if end is None else end - time.time()
+            if remaining is not None and remaining <= 0:
+                return changed
+            changed = self.changes(remaining)
+        while True:
+            more = self.changes(self.delay)
+            if not more:
+                return changed
+            changed.update(more)
+
+    def __iter__(self):
+        while True:
+            yield self.wait()
+
+    def close(self):
+        if self.fd is not None:
+            self.selector.close()
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+FORK_SERVER = '''
+import array, json, os, signal, socket, subprocess, sys, threading
+path = sys.argv[1]
+server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+server.bind(path)
+os.chmod(path, 0o600)
+if os.environ.get('SUDO_UID'):
+    os.chown(path, int(os.environ['SUDO_UID']), int(os.environ['SUDO_GID']))
+server.listen(1)
+conn = server.accept()[0]
+server.close()
+os.unlink(path)
+os.rmdir(os.path.dirname(path))
+lock = threading.Lock()
+processes = {}
+def send(message):
+    with lock:
+        conn.sendall(json.dumps(message).encode('utf8') + b'\\n')
+def wait(index, p):
+    send(dict(id=index, returncode=p.wait()))
+buf, fds = b'', []
+size = socket.CMSG_LEN(48 * array.array('i').itemsize)
+while True:
+    data, ancdata, flags, addr = conn.recvmsg(65536, size)
+    if not data:
+        break
+    for level, kind, cdata in ancdata:
+        a = array.array('i')
+        a.frombytes(cdata[:len(cdata) - len(cdata) % a.itemsize])
+        fds.extend(a)
+    buf += data
+    lines = buf.split(b'\\n')
+    buf = lines.pop()
+    for line in lines:
+        message = json.loads(line.decode('utf8'))
+        if 'kill' in message:
+            p = processes.get(message['kill'])
+            if p is not None and p.poll() is None:
+                p.kill()
+            continue
+        index = message['id']
+        stdio, fds = fds[:3], fds[3:]
+        env = message['env']
+        if env is None:
+            env = dict(os.environ)
+        env.update(message['env_update'])
+        try:
+            p = subprocess.Popen(message['args'], stdin=stdio[0],
+                                 stdout=stdio[1], stderr=stdio[2],
+                                 executable=message['executable'],
+                                 start_new_session=message[
+                                     'start_new_session'],
+                                 env=env, cwd=message['cwd'])
+        except OSError as e:
+            send(dict(id=index, error=str(e)))
+        else:
+            processes[index] = p
+            send(dict(id=index, pid=p.pid))
+            t = threading.Thread(target=wait, args=(index, p))
+            t.daemon = True
+            t.start()
+        finally:
+            for fd in stdio:
+                os.close(fd)
+'''.lstrip()
 
 SCRIPT_HEADER = '''
 #!/usr/bin/env %(interpreter)s
@@ -1111,29 +3757,47 @@ SCRIPT_HEADER = '''
 
 version = %(version)s
 
-import base64, json, types, zlib, sys, os
+import sys, os
 os.environ['CHUTIFIED'] = '1'
-_chut_modules = []
 '''.lstrip()
 
 LOAD_MODULES = '''
-for name, code in _chut_modules:
-    if isinstance(code, str):
-        code = code.encode('utf-8')
-    code = zlib.decompress(base64.decodebytes(code))
-    mod = types.ModuleType(name)
-    globs = dict()
-    if isinstance(code, bytes):
-        code = code.decode('utf-8')
-    exec(code, globs)
-    mod.__dict__.update(globs)
-    if name == 'chut':
-        mod.wraps_module(mod)
-    else:
-        sys.modules[name] = mod
+class _ChutImporter(object):
+    # import embedded modules on demand. use the bytecode when it was compiled
+    # for this interpreter
+
+    def __init__(self, modules):
+        self.modules = dict((m[0], m) for m in modules)
+
+    def find_spec(self, name, path=None, target=None):
+        if name in self.modules:
+            from importlib.machinery import ModuleSpec
+            return ModuleSpec(name, self)
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, mod):
+        import base64, zlib
+        item = self.modules[mod.__name__]
+        if item[2:3] == (sys.implementation.cache_tag,):
+            import marshal
+            code = zlib.decompress(base64.decodebytes(item[3].encode()))
+            code = marshal.loads(code)
+        else:
+            code = zlib.decompress(base64.decodebytes(item[1].encode()))
+            code = compile(code, '<%s>' % mod.__name__, 'exec')
+        exec(code, mod.__dict__)
+sys.meta_path.insert(0, _ChutImporter(_chut_modules))
 from chut import env
 '''.lstrip()
 
+COMPILE_PYC = '''
+import sys
+tag, data = pyc(sys.stdin.buffer.read(), sys.argv[1])
+sys.stdout.buffer.write(tag.encode('ascii') + b'\\n' + data)
+'''
+
 ##########
 # Fabric #
 ##########
@@ -1142,25 +3806,51 @@ from chut import env
 class Fab(object):
 
     dirname = '.chutifab'
+    digest_size = 12
     scripts = []
 
+    def remote_script(self, script):
+        """Return the local path of a script and its remote path. The remote
+        name contains a digest of the script so an unchanged script is never
+        uploaded twice"""
+        import hashlib
+        local = os.path.join(self.dirname, script)
+        with open(local, 'rb') as fd:
+            digest = hashlib.sha256(fd.read()).hexdigest()[:self.digest_size]
+        return local, posixpath.join(self.dirname,
+                                     '%s-%s' % (script, digest))
+
     def _run(self, meth, script, *args, **kwargs):  # pragma: no cover
+        try:
+            from fabric import api as fabric
+        except ImportError:
+            return None
         if script not in self.scripts:
             scripts = sorted(sh.ls('.chutifab'))
             fabric.abort((
                 'No such script {0}. Available scripts are:\n\n- {1}'
             ).format(script, '\n- '.join(scripts)))
-        if HAS_FABRIC:
-            meth = getattr(fabric, meth)
-            with fabric.settings(fabric.hide('stdout', 'running')):
-                res = meth(('test -d ~/{0} || mkdir ~/{0} && chmod 700 ~/{0}; '
-                            'echo $HOME/{0}').format(self.dirname))
-                remote = posixpath.join(res, script)
-                fabric.put('.chutifab/' + script, remote, mode=0o700,
+        meth = getattr(fabric, meth)
+        local, remote = self.remote_script(script)
+        with fabric.settings(fabric.hide('stdout', 'running')):
+            lines = meth(self.check_cmd(script, remote) + '; echo $HOME')
+            lines = lines.split()
+            remote = posixpath.join(lines[-1], remote)
+            if 'current' not in lines:
+                fabric.put(local, remote, mode=0o700,
                            use_sudo=bool(meth.__name__ == 'sudo'))
-            cmd = '{0} {1}'.format(remote, ' '.join(args))
-            res = meth(cmd, **kwargs)
-            return res
+        cmd = '{0} {1}'.format(remote, ' '.join(args))
+        res = meth(cmd, **kwargs)
+        return res
+
+    def check_cmd(self, script, remote):
+        # print current if the script is up to date. else remove old versions.
+        # only match the digest so scripts sharing a prefix are kept
+        return ('test -x ~/{remote} && echo current || {{ '
+                'mkdir -p -m 700 ~/{dirname}; '
+                'rm -f ~/{dirname}/{script}-{digest}; }}').format(
+                    remote=remote, dirname=self.dirname, script=script,
+                    digest='?' * self.digest_size)
 
     def chutifab(self, *args):
         """Generate chut scripts contained in location"""
@@ -1185,6 +3875,45 @@ class Fab(object):
         line arguments. ``**kwargs`` are passed to `fabric`'s `sudo`"""
         return self._run('sudo', script, *args, **kwargs)
 
+    def run_many(self, hosts, script, *args, **kwargs):
+        """Upload a script to many hosts (only where it changed) and run it
+        using ssh. Hosts are processed concurrently. Yield ``(host, output)``
+        as soon as a host is done. ``*args`` are used as command line
+        arguments. ``kwargs`` can contain ``sudo=True`` and the arguments of
+        :class:`~chut.SSHGroup`"""
+        sudo = kwargs.pop('sudo', False)
+        local, remote = self.remote_script(script)
+        group = SSHGroup(hosts, **kwargs)
+        upload = []
+        ready = []
+        for host, output in group(self.check_cmd(script, remote)):
+            if output.failed:
+                yield host, output
+            elif 'current' in output:
+                ready.append(host)
+            else:
+                upload.append(host)
+        if upload:
+            scp = sh[aliases.get('scp', 'scp')]
+
+            def command(host):
+                return scp('-p', local, '%s:%s' % (host, remote))
+
+            batch = Batch(command, upload, group.pool_size, False,
+                          dict(stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
+                               env=env), timeout=group.timeout)
+            for index, output in batch.completed():
+                if output.failed:
+                    yield upload[index], output
+                else:
+                    ready.append(upload[index])
+        cmd = ' '.join(['~/' + remote] + [str(a) for a in args])
+        if sudo:
+            cmd = 'sudo ' + cmd
+        group.hosts = ready
+        for host, output in group(cmd):
+            yield host, output
+
 
 fab = Fab()
 
@@ -29,6 +29,7 @@ def chutify(args):
     -d DIR, --destination=DIR     Destination [default: dist/scripts]
     -i X, --interpreter=X         Python interpreter to use
     -n X, --new-version=X         Set new scripts version
+    --format=X                    Output format: source, bytecode or zipapp
     %options-30s
     """
     config = sh.ini('.chut')
@@ -41,6 +42,7 @@ def chutify(args):
     if interpreter in ('2', '3'):  # pragma: no cover
         interpreter = 'python' + interpreter
     args['--interpreter'] = interpreter
+    args['--format'] = args['--format'] or cfg.format or 'source'
 
     location = args.get('<location>') or cfg.location or os.getcwd()
     location = os.path.expanduser(location)
@@ -78,8 +80,14 @@ def chutify(args):
     commands = cfg.run.as_list('\n')
     commands = [c.strip() for c in commands if c.strip()]
 
-    def gen():
-        scripts = generator(location)
+    def gen(filenames=None):
+        if filenames is None:
+            scripts = generator(location)
+        else:
+            # files may be removed or not contain scripts anymore
+            filenames = [f for f in filenames if os.path.isfile(f) and
+                         generator.parse(f)[0]]
+            scripts = generator.build(sorted(filenames))
         for cmd in commands:
             print('$ %s' % cmd)
             if ' ' in cmd:
@@ -90,13 +98,13 @@ def chutify(args):
         return scripts
 
     if args['--loop']:  # pragma: no cover
-        import time
-        while True:
-            try:
-                gen()
-                time.sleep(.1)
-            except KeyboardInterrupt:
-                return 0
+        gen()
+        try:
+            with sh.Watcher(location) as watcher:
+                for filenames in watcher:
+                    gen(filenames)
+        except KeyboardInterrupt:
+            return 0
     else:
         scripts = gen()
         if sh.env.git_dir:  # pragma: no cover
@@ -4,8 +4,11 @@ from chut.recipe import Recipe
 from chut.scripts import chutify
 from io import StringIO
 import chut as sh
+import threading
 import unittest
 import os
+import sys
+import time
 
 
 os.environ['TESTING'] = '1'
@@ -20,6 +23,41 @@ class Chut(unittest.TestCase):
         self.assertEqual(sh.rm('/chut').failed, True)
         self.assertTrue(len(sh.rm('/chut').stderr) >= 0)
 
+    def test_run_once(self):
+        pipe = sh.pipe('sh', '-c "echo run >> tmp"')
+        if pipe:
+            str(pipe)
+        self.assertTrue(pipe.succeeded)
+        self.assertFalse(pipe.failed)
+        self.assertEqual(pipe(), pipe.result)
+        self.assertEqual(len(list(sh.cat('tmp'))), 1)
+        self.assertTrue(pipe.result.duration >= 0)
+        self.assertRaises(AttributeError, setattr, pipe.result, 'stderr', '')
+        pipe.rerun()
+        self.assertEqual(len(list(sh.cat('tmp'))), 2)
+        # iteration stores the status but not the output
+        pipe = sh.pipe('sh', '-c "echo run >> tmp; echo hi"')
+        self.assertEqual(list(pipe), ['hi'])
+        self.assertTrue(pipe.result.consumed)
+        self.assertTrue(pipe.succeeded)
+        self.assertEqual(pipe(), pipe.result)
+        self.assertRaises(ValueError, str, pipe)
+        self.assertEqual(len(list(sh.cat('tmp'))), 3)
+        self.assertFalse(pipe(combine_stderr=True).consumed)
+        self.assertEqual(len(list(sh.cat('tmp'))), 4)
+
+    def test_large_stderr(self):
+        noisy = sh.pipe('sh', '-c "head -c 200000 /dev/zero >&2; echo ok"')
+        pipe = noisy | sh.cat(max_stderr=1000)
+        self.assertEqual(str(pipe), 'ok')
+        self.assertEqual(len(pipe.stderr), 1000)
+        self.assertEqual(list(noisy | sh.cat()), ['ok'])
+        # options can be given to any command of the pipe
+        pipe = sh.pipe('sh', '-c "head -c 200000 /dev/zero >&2; echo ok"',
+                       max_stderr=10, max_stdout=1) | sh.cat()
+        self.assertEqual(str(pipe), 'o')
+        self.assertEqual(len(pipe.stderr), 10)
+
     def test_repr(self):
         self.assertEqual(repr(sh.stdin(b'') | sh.cat('-')),
                          repr(str('stdin | cat -')))
@@ -62,11 +100,138 @@ class Chut(unittest.TestCase):
     def test_iter_stdin(self):
         self.assertTrue(isinstance(sh.stdin(b'blah').iter_stdout, int))
         self.assertTrue(isinstance(sh.stdin('blah').iter_stdout, int))
-        self.assertTrue(isinstance(sh.stdin(StringIO('')).iter_stdout,
-                        StringIO))
+        self.assertTrue(isinstance(sh.stdin(StringIO('')).iter_stdout, int))
         with open(__file__, 'rb') as fd:
             self.assertEqual(sh.stdin(fd).iter_stdout, fd)
 
+    def test_async(self):
+        import asyncio
+
+        async def main():
+            output = await (sh.stdin(b'a\nb') | sh.grep('a'))
+            self.assertEqual(output, 'a')
+            lines = []
+            async for line in sh.cat(__file__) | sh.head('-n2'):
+                lines.append(line)
+            self.assertEqual(len(lines), 2)
+            lines = []
+            async for line in sh.stdin(b'a\n\nb') | sh.cat():
+                lines.append(line)
+            self.assertEqual(lines, ['a', '', 'b'])
+            results = await asyncio.gather(sh.echo('x'), sh.ls('/chut'))
+            self.assertEqual(results[0], 'x')
+            self.assertTrue(results[1].failed)
+            self.assertTrue(results[1].stderr)
+            # python stages
+            for backend in ('thread', 'process'):
+                upper = sh.wraps(lambda stdin: (i.upper() for i in stdin),
+                                 backend=backend)
+                output = await (sh.stdin(b'a\nb\n') | upper | sh.grep('A'))
+                self.assertEqual(output, 'A')
+            self.assertEqual(await (sh.echo('c') | upper), 'C')
+            # processes are killed when the iteration stops
+            pipe = sh.tail('-f', __file__)
+            async for line in pipe:
+                break
+            await asyncio.sleep(.2)
+            self.assertIsNotNone(pipe.processes[0].returncode)
+            # and on timeout
+            output = await (sh.sleep(5, timeout=.2) | sh.cat)
+            self.assertEqual(output.timed_out, 'sleep 5')
+            # stats without resource usage
+            upper = sh.wraps(lambda stdin: (i.upper() for i in stdin))
+            output = await (sh.cat(__file__, stats=True) | upper |
+                            sh.wc('-c'))
+            size = os.path.getsize(__file__)
+            cat, func, wc = output.stats
+            self.assertEqual((cat.read, func.read, wc.written),
+                             (size, size, size))
+            self.assertEqual(wc.read, len(output) + 1)
+            self.assertEqual([s.returncode for s in output.stats], [0] * 3)
+            self.assertIsNone(cat.user)
+            self.assertTrue(wc.wall >= 0)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(main())
+        loop.close()
+        # leaving a loop early is quiet at the end of asyncio.run
+        script = (b'import asyncio, chut as sh\n'
+                  b'sh.Pipe.kill_delay = .2\n'
+                  b'async def main():\n'
+                  b'    cmd = ["trap : TERM; echo; sleep 1"]\n'
+                  b'    async for line in sh.pipe("sh", "-c", cmd):\n'
+                  b'        break\n'
+                  b'asyncio.run(main())\n')
+        output = (sh.stdin(script) | sh.pipe(sys.executable, '-'))()
+        self.assertTrue(output.succeeded)
+        self.assertEqual(output.stderr, '')
+
+    def test_iter_bytes(self):
+        with open(__file__, 'rb') as fd:
+            content = fd.read()
+        chunks = list(sh.cat(__file__).iter_bytes(100))
+        self.assertEqual(b''.join(chunks), content)
+        self.assertTrue(max(len(c) for c in chunks) <= 100)
+        lines = list(sh.cat(__file__).iter_lines(raw=True))
+        self.assertEqual(lines, content.rstrip().split(b'\n'))
+        lines = list(sh.cat(__file__).iter_lines(raw=True, chunk_size=7))
+        self.assertEqual(lines, content.rstrip().split(b'\n'))
+        record = sh.pipe('head', '-c', '200000', '/dev/zero')
+        lines = list(record.iter_lines(raw=True, chunk_size=100))
+        self.assertEqual([len(i) for i in lines], [200000])
+        pipe = sh.cat(__file__)
+        buf = bytearray(1000)
+        output = b''
+        size = pipe.readinto(buf)
+        while size:
+            output += buf[:size]
+            size = pipe.readinto(buf)
+        self.assertEqual(output, content)
+        # the pipe is not started again at the end of the output
+        self.assertEqual(pipe.readinto(buf), 0)
+        self.assertTrue(pipe.succeeded)
+        pipe = sh.pipe('sh', '-c "echo run >> tmp; echo ok"')
+        self.assertEqual(pipe.readinto(buf), 3)
+        self.assertEqual(pipe.readinto(buf), 0)
+        self.assertEqual(pipe.readinto(buf), 0)
+        self.assertEqual(len(list(sh.cat('tmp'))), 1)
+        sh.rm('tmp')
+
+    def test_command_line_cache(self):
+        from unittest import mock
+        pipe = sh.grep('-E "a b"', ['c'])
+        self.assertEqual(pipe.command_line(), ['grep', '-E', 'a b', 'c'])
+        with mock.patch('shlex.split') as split:
+            pipe.command_line().append('x')
+            self.assertEqual(pipe.command_line(),
+                             ['grep', '-E', 'a b', 'c'])
+            self.assertFalse(split.called)
+        pipe.args.append('d')
+        self.assertEqual(pipe.command_line()[-1], 'd')
+        pipe.args[1].append('e')
+        self.assertEqual(pipe.command_line()[-2:], ['e', 'd'])
+        self.assertEqual(pipe.command_line(shell=True), 'grep -E "a b" c e d')
+
+    def test_resolve(self):
+        import tempfile
+        tmp = tempfile.mkdtemp()
+        dirs = [os.path.join(tmp, 'a'), os.path.join(tmp, 'b')]
+        for dirname in dirs:
+            os.mkdir(dirname)
+        script = os.path.join(dirs[1], 'chut-cmd')
+        sh.stdin(b'#!/bin/sh\necho b') > script
+        self.assertEqual(sh.resolve('chut-cmd', dirs), None)
+        os.chmod(script, 0o755)
+        self.assertEqual(sh.resolve('chut-cmd', dirs), script)
+        with sh.env(path=dirs + sh.env.path):
+            self.assertEqual(str(sh['chut-cmd']()), 'b')
+            sh.stdin(b'#!/bin/sh\necho a') > os.path.join(dirs[0], 'chut-cmd')
+            sh.chmod('+x', os.path.join(dirs[0], 'chut-cmd'))
+            self.assertEqual(str(sh['chut-cmd']()), 'a')
+        self.assertEqual(sh.resolve('chut-cmd'), None)
+        sh.rm('-rf', tmp)
+
     def test_slices(self):
         pipe = sh.cat('tmp') | sh.grep('tmp') | sh.wc('-l')
         self.assertEqual(pipe[0:1]._binary, 'cat')
@@ -104,6 +269,35 @@ class Chut(unittest.TestCase):
             cmd >> 'tmp'
         self.assertFalse(ls == str(sh.ls('-l tmp')), ls)
 
+    def test_python_stages(self):
+        def upper(stdin):
+            for line in stdin:
+                yield line.upper()
+
+        for backend in ('thread', 'process'):
+            py = sh.wraps(upper, backend=backend)
+            pipe = sh.stdin('a\nb\n') | py | sh.grep('B')
+            self.assertEqual(str(pipe), 'B')
+            pipe = sh.stdin(b'x\n' * 100000) | py | sh.head('-n1')
+            self.assertEqual(str(pipe), 'X')
+            pipe = sh.stdin(b'y\n' * 10) | py | py | sh.wc('-l')
+            self.assertEqual(str(pipe), '10')
+
+        @sh.wraps
+        def fail(stdin):
+            raise ValueError()
+            yield
+
+        self.assertTrue((sh.stdin(b'') | fail | sh.cat()).failed)
+
+        @sh.wraps
+        def records(stdin):
+            yield b'a'
+            yield 'b\n'
+
+        # items of the last function are not merged
+        self.assertEqual(list(sh.stdin(b'') | records), ['a', 'b'])
+
     def test_stdin(self):
         content = open(__file__).read().strip()
         if not isinstance(content, bytes):
@@ -137,6 +331,43 @@ class Chut(unittest.TestCase):
         sh.stdin(b'blah') >> 'tmp'
         self.assertEqual(str(sh.cat('tmp')), 'blahblah')
 
+    def test_stdin_stream(self):
+        data = b'x' * 1000000
+        self.assertEqual(str(sh.stdin(data) | sh.wc('-c')), '1000000')
+        self.assertEqual(str(sh.stdin(memoryview(data)) | sh.wc('-c')),
+                         '1000000')
+        lines = ('line %s\n' % i for i in range(100000))
+        self.assertEqual(str(sh.stdin(lines) | sh.wc('-l')), '100000')
+        self.assertEqual(str(sh.stdin(StringIO('é')) | sh.cat()), 'é')
+        self.assertEqual(str(sh.stdin(data) | sh.head('-c 3')), 'xxx')
+
+        def broken():
+            yield 'line\n'
+            raise ValueError('broken')
+
+        output = (sh.stdin(broken()) | sh.cat())()
+        self.assertTrue(output.failed)
+        self.assertEqual(output, 'line')
+
+    def test_redirect_input(self):
+        content = open(__file__).read().strip()
+        self.assertEqual(str(sh.cat() < __file__), content)
+        self.assertEqual(str((sh.grep('import') < __file__) | sh.wc('-l')),
+                         str(sh.grep('-c', 'import', __file__)))
+        sh.stdin(sh.path.lib(__file__)) > 'tmp'
+        self.assertEqual(str(sh.cat('tmp')), content)
+        with open(__file__, 'rb') as fd:
+            sh.stdin(fd) >> 'tmp'
+        self.assertEqual(str(sh.cat('tmp')), content + '\n' + content)
+
+    def test_copy_fd(self):
+        r, w = os.pipe()
+        with open(__file__, 'rb') as fd:
+            sh.copy_fd(fd.fileno(), w)
+        os.close(w)
+        with open(__file__, 'rb') as fd, os.fdopen(r, 'rb') as r:
+            self.assertEqual(r.read(), fd.read())
+
     def test_stdin2(self):
         head = str(
             sh.stdin(open(self.__file__, 'rb')
@@ -163,10 +394,186 @@ class Chut(unittest.TestCase):
         sh.stdin(b'#!/bin/bash\necho gawel') > 'sudo'
         self.assertRaises(OSError, sh.check_sudo)
 
+    def test_sudo_helper(self):
+        old_sudo = sh.aliases['sudo']
+        sh.aliases['sudo'] = sh.path.join(sh.pwd(), 'sudo')
+        sh.stdin(b'#!/bin/sh\necho x >> tmp\n'
+                 b'[ "$1" = "-s" ] && shift\n'
+                 b'[ "$1" = "whoami" ] && echo root && exit\n'
+                 b'exec "$@"\n') > 'sudo'
+        sh.chmod('+x sudo')
+        try:
+            sh.check_sudo()
+            sh.check_sudo()
+            self.assertEqual(len(list(sh.cat('tmp'))), 1)
+            with sh.SudoHelper():
+                pipe = sh.sudo.cat(__file__) | sh.sudo.grep('chut')
+                self.assertTrue(len(list(pipe)) > 1)
+                pipe = sh.stdin(b'a\nb') | sh.sudo.grep('b')
+                self.assertEqual(str(pipe), 'b')
+                self.assertTrue(sh.sudo.ls('/chut').failed)
+                self.assertTrue(sh.sudo.ls('/chut')().stderr)
+                # only the variables given to the command are passed
+                with sh.env(CHUT_LEAK='1'):
+                    self.assertNotIn('CHUT_LEAK', str(sh.sudo.env()))
+                    pipe = sh.sudo.env(env=sh.env.copy(CHUT_VAR='2'))
+                    self.assertIn('CHUT_VAR=2', str(pipe))
+            self.assertEqual(len(list(sh.cat('tmp'))), 2)
+        finally:
+            sh.aliases['sudo'] = old_sudo
+
     def test_ssh(self):
         self.assertRaises(NotImplementedError, sh.ssh('x').cd, '/tmp')
         self.assertRaises(NotImplementedError, sh.ssh('x').pwd)
 
+    def test_launcher(self):
+        for launcher in ('spawn', 'forkserver'):
+            pipe = (sh.cat('README.rst', launcher=launcher) |
+                    sh.grep('Chut', launcher=launcher) | sh.head('-n1'))
+            self.assertEqual(str(pipe), 'Chut!')
+            pipe = sh.pipe('sh', '-c', 'pwd', launcher=launcher, cwd='/tmp')
+            self.assertEqual(str(pipe), '/tmp')
+            pipe = sh.ls('/nope', launcher=launcher)
+            self.assertTrue(pipe().failed)
+            self.assertIn('/nope', pipe.stderr)
+            self.assertEqual(list(sh.echo.map('ab', launcher=launcher)),
+                             ['a', 'b'])
+            with self.assertRaises(OSError):
+                sh.pipe('nonexistingcmd', launcher=launcher)()
+        # waiting for a long command does not block other spawns
+        slow = sh.ForkServer.get().popen(['sleep', '1'], {})
+        waiting = threading.Thread(target=slow.wait)
+        waiting.start()
+        start = time.time()
+        self.assertEqual(str(sh.echo('x', launcher='forkserver')), 'x')
+        self.assertLess(time.time() - start, .5)
+        waiting.join()
+        self.assertEqual(slow.returncode, 0)
+        pipe = sh.pipe('sh', '-c', 'pwd', launcher='spawn')
+        pipe()
+        self.assertIsInstance(pipe.processes[0], sh.SpawnedProcess)
+        pipe = sh.pipe('sh', '-c', 'pwd', launcher='spawn', cwd='/tmp')
+        pipe()
+        self.assertIsInstance(pipe.processes[0], sh.HelperProcess)
+
+    def test_ssh_multiplex(self):
+        environ = dict(os.environ)
+        old_ssh = sh.aliases['ssh']
+        sh.aliases['ssh'] = sh.path.join(sh.pwd(), 'sudo')
+        sh.stdin(b'#!/bin/sh\necho "$@" >> tmp\n'
+                 b'for last; do :; done\n'
+                 b'case "$*" in *"-O exit"*) exit 0;; esac\n'
+                 b'exec sh -c "$last"\n') > 'sudo'
+        sh.chmod('+x sudo')
+        try:
+            with sh.ssh('host') as srv:
+                self.assertEqual(str(srv.echo('remote')), 'remote')
+                with sh.ssh('host') as srv2:
+                    self.assertEqual(str(srv2(sh.echo('x'))), 'x')
+                # simulate the master socket
+                sh.stdin(b'') > srv.control_path
+                self.assertFalse(sh.grep('-c', 'exit', 'tmp').succeeded)
+            log = list(sh.cat('tmp'))
+            self.assertIn('-o ControlMaster=auto', log[0])
+            self.assertIn('ControlPersist=60', log[0])
+            self.assertIn('-O exit host', log[-1])
+            self.assertEqual(len(log), 3)
+            sh.rm('-f', srv.control_path)
+            str(sh.ssh('host', multiplex=False).ls())
+            self.assertNotIn('ControlMaster', list(sh.cat('tmp'))[-1])
+            # the socket directory must be private
+            sh.mkdir('-m', '755', 'tmpdir')
+            with self.assertRaises(PermissionError):
+                sh.ssh('host', control_dir='tmpdir').control_path
+            # no multiplexing when the default directory can not be created
+            os.environ.pop('XDG_RUNTIME_DIR', None)
+            os.environ['HOME'] = os.path.abspath('tmpdir/home')
+            srv = sh.ssh('host')
+            self.assertIsNone(srv.control_path)
+            self.assertEqual(str(srv.echo('x')), 'x')
+            self.assertNotIn('ControlMaster', list(sh.cat('tmp'))[-1])
+            self.assertFalse(os.path.exists('tmpdir/home'))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            sh.aliases['ssh'] = old_ssh
+            sh.rm('-Rf', 'tmpdir')
+
+    def test_ssh_group(self):
+        old_ssh = sh.aliases['ssh']
+        sh.aliases['ssh'] = sh.path.join(sh.pwd(), 'sudo')
+        sh.stdin(b'#!/bin/sh\nfor last; do host=$cur; cur=$last; done\n'
+                 b'case $host in slow) sleep 5;; bad) exit 3;; esac\n'
+                 b'exec sh -c "echo $host; $last"\n') > 'sudo'
+        sh.chmod('+x sudo')
+        try:
+            group = sh.ssh_group(['slow', 'h1', 'bad', 'h2'],
+                                 pool_size=4, timeout=1)
+            results = list(group(sh.echo('ok')))
+            self.assertEqual(results[-1][0], 'slow')
+            self.assertEqual(dict(results)['h1'], 'h1\nok')
+            self.assertEqual(sorted(group.failures), ['bad', 'slow'])
+            self.assertIn('slow', group.failures['slow'].timed_out)
+            summary = group.summary()
+            self.assertTrue(summary.startswith('4 hosts, 2 failed'))
+            self.assertIn('bad: 3', summary)
+            self.assertIn('slow: -15 timed out', summary)
+        finally:
+            sh.aliases['ssh'] = old_ssh
+
+    def test_import_time(self):
+        # heavy modules are imported on first use
+        import subprocess
+        import sys
+        code = ('import sys, chut; print([m for m in ('
+                '"inspect", "zlib", "base64", "ConfigObject", "docopt", '
+                '"fabric") if m in sys.modules])')
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(output.strip(), b'[]')
+        # resolved attributes are cached by the module wrapper
+        self.assertIs(sh.cat, sh.cat)
+        self.assertIn('cat', sh.__dict__)
+
+    def test_fab_run_many(self):
+        root = os.path.abspath('tmp')
+        sh.mkdir('-p', 'tmp/bin', '.chutifab')
+        sh.stdin(b'#!/bin/sh\necho hello "$@"\n') > '.chutifab/hello'
+        sh.chmod('+x', '.chutifab/hello')
+        sh.stdin(('#!/bin/sh\nfor last; do host=$cur; cur=$last; done\n'
+                  'test $host = bad && exit 255\n'
+                  'mkdir -p %s/$host && cd %s/$host\n'
+                  'HOME=$PWD exec sh -c "$last"\n' % (root, root)
+                  ).encode()) > 'tmp/bin/ssh'
+        sh.stdin(('#!/bin/sh\ndst=$3; host=${dst%%%%:*}\n'
+                  'echo $host >> %s/uploads\n'
+                  'exec cp -p "$2" "%s/$host/${dst#*:}"\n' % (root, root)
+                  ).encode()) > 'tmp/bin/scp'
+        sh.chmod('+x', 'tmp/bin/ssh', 'tmp/bin/scp')
+        old_aliases = sh.aliases.copy()
+        sh.aliases.update(ssh=root + '/bin/ssh', scp=root + '/bin/scp')
+        try:
+            results = dict(sh.fab.run_many(['h1', 'h2', 'bad'], 'hello',
+                                           'world', multiplex=False))
+            self.assertEqual(results['h1'], 'hello world')
+            self.assertEqual(results['h2'], 'hello world')
+            self.assertTrue(results['bad'].failed)
+            # old versions are removed. not other scripts
+            sh.mkdir('-p', 'tmp/h3/.chutifab')
+            for name in ('hello-0123456789ab', 'hello-world-0123456789ab'):
+                sh.touch('tmp/h3/.chutifab/' + name)
+            results = dict(sh.fab.run_many(['h1', 'h3'], 'hello',
+                                           multiplex=False))
+            self.assertEqual(results, {'h1': 'hello', 'h3': 'hello'})
+            self.assertEqual(len(list(sh.ls('tmp/h3/.chutifab'))), 2)
+            self.assertFalse(os.path.exists(
+                'tmp/h3/.chutifab/hello-0123456789ab'))
+            self.assertEqual(sorted(sh.cat('tmp/uploads')),
+                             ['h1', 'h2', 'h3'])
+        finally:
+            sh.aliases.clear()
+            sh.aliases.update(old_aliases)
+            sh.rm('-Rf', 'tmp', '.chutifab')
+
     def test_version(self):
         @sh.console_script
         def w(args):
@@ -200,6 +607,66 @@ class Chut(unittest.TestCase):
         self.assertEqual(generator('chut/scripts.py'),
                          ['dist/scripts/chutify'])
 
+    def test_build_cache(self):
+        generator = sh.Generator(destination='dist/cache', cache_file='tmp')
+        scripts = generator('chut/scripts.py')
+        mtime = os.stat(scripts[0]).st_mtime_ns
+        self.assertEqual(generator('chut/scripts.py'), scripts)
+        self.assertEqual(os.stat(scripts[0]).st_mtime_ns, mtime)
+        sh.rm(scripts[0])
+        self.assertEqual(generator('chut/scripts.py'), scripts)
+        self.assertTrue(os.path.isfile(scripts[0]))
+        # other files are generated by a pool of processes
+        scripts = generator('chut')
+        self.assertIn('dist/cache/chutify', scripts)
+        self.assertTrue(all(os.path.isfile(s) for s in scripts))
+
+    def test_requirements(self):
+        self.assertEqual(
+            sh.missing_requirements(['chut', 'docopt>=0.1', 'docopt>=1000',
+                                     'chut-nosuchpackage',
+                                     'git+https://host/x.git#egg=x']),
+            ['docopt>=1000', 'chut-nosuchpackage',
+             'git+https://host/x.git#egg=x'])
+        stamp = sh.requirements_stamp(['chut', 'docopt'])
+        self.assertEqual(stamp, sh.requirements_stamp(['docopt', 'chut']))
+        self.assertNotEqual(stamp, sh.requirements_stamp(['chut']))
+
+    def test_parse(self):
+        sh.stdin(b'import chut as sh\n__version__ = "0.1"\n\n'
+                 b'@sh.console_script(fmt="msg")\ndef a_b(args):\n    pass\n'
+                 b'\ndef helper():\n    pass\n') > 'tmp.py'
+        generator = sh.Generator(destination='dist/parse', version='0.2',
+                                 cache_file='tmp')
+        self.assertEqual(generator.parse('tmp.py'), (['a_b'], '0.1'))
+        self.assertEqual(generator('tmp.py'), ['dist/parse/a-b'])
+        self.assertEqual(generator.parse('tmp.py'), (['a_b'], '0.2'))
+        sh.rm('tmp.py')
+
+    def test_watcher(self):
+        sh.mkdir('-p', 'tmp/sub')
+        for inotify in (True, False):
+            with sh.Watcher('tmp', delay=.05, interval=.05,
+                            inotify=inotify) as watcher:
+                self.assertEqual(watcher.wait(.1), set())
+                sh.stdin(b'x') > 'tmp/sub/a.py'
+                sh.stdin(b'x') > 'tmp/b.txt'
+                sh.stdin(b'x') > 'tmp/.#c.py'
+                self.assertEqual(watcher.wait(2),
+                                 set([os.path.abspath('tmp/sub/a.py')]))
+        with sh.Watcher('tmp/sub/a.py', delay=.05) as watcher:
+            sh.stdin(b'y') > 'tmp/sub/a.py'
+            self.assertEqual(len(watcher.wait(2)), 1)
+        sh.rm('-Rf', 'tmp')
+
+    def test_generate_formats(self):
+        for fmt in ('bytecode', 'zipapp'):
+            generator = sh.Generator(destination='dist/' + fmt, format=fmt)
+            script = generator('chut/scripts.py')[0]
+            output = sh.pipe(script, '--help')
+            self.assertTrue(str(output).startswith('Usage: chutify'))
+        self.assertRaises(ValueError, sh.Generator, format='exe')
+
     def test_chutify(self):
         self.assertEqual(chutify(['chut/scripts.py']), 0)
         self.assertEqual(chutify(['.']), 0)
@@ -222,6 +689,107 @@ class Chut(unittest.TestCase):
         self.assertRaises(OSError, list,
                           sh.rm.map(['/chut'], stop_on_failure=True))
 
+    def test_map_output(self):
+        args = ['-c "sleep .2; echo 0"', '-c "head -c 200000 /dev/zero"',
+                '-c "echo 2"']
+        results = list(sh.sh['sh'].map(args, pool_size=2))
+        self.assertEqual([len(r) for r in results], [1, 200000, 1])
+        self.assertEqual(results[2], '2')
+        self.assertTrue(all(r.succeeded for r in results))
+
+    def test_timeout(self):
+        start = time.time()
+        pipe = sh.sh['sh']('-c "sleep 5; echo done"', timeout=.3) | sh.cat
+        output = pipe()
+        self.assertTrue(output.failed)
+        self.assertEqual(output.timed_out, "sh -c 'sleep 5; echo done'")
+        # the whole process group is killed
+        output = sh.sh['sh']('-c "echo a; sleep 5 | cat"', idle_timeout=.3)()
+        self.assertEqual(output, 'a')
+        self.assertTrue(output.timed_out)
+        self.assertLess(time.time() - start, 3)
+        results = list(sh.sh['sh'].map(['-c "sleep 5"', '-c "echo ok"'],
+                                       timeout=.3))
+        self.assertTrue(results[0].timed_out)
+        self.assertEqual(results[1], 'ok')
+        self.assertIsNone(results[1].timed_out)
+
+    def test_stats(self):
+        self.assertIsNone((sh.cat('README.rst') | sh.grep('Chut'))().stats)
+        pipe = sh.stdin(b'b\na\n' * 1000) | sh.grep('a', stats=True) | \
+            sh.wc('-l')
+        output = pipe()
+        self.assertEqual(output, '1000')
+        grep, wc = output.stats
+        self.assertEqual((grep.command, wc.command), ('grep a', 'wc -l'))
+        self.assertEqual(grep.written, 4000)
+        self.assertEqual(wc.read, len('1000\n'))
+        self.assertEqual(grep.returncode, 0)
+        self.assertTrue(grep.wall >= 0 and grep.spawn >= 0)
+        self.assertIsNotNone(wc.user)
+        results = list(sh.sh['sh'].map(['-c "echo ok"', '-c "exit 2"'],
+                                       stats=True))
+        self.assertEqual(results[0].stats[0].read, 3)
+        self.assertEqual(results[1].stats[0].returncode, 2)
+        # bytes read and written by a python stage
+        upper = sh.wraps(lambda stdin: (i.upper() for i in stdin))
+        output = (sh.cat('README.rst', stats=True) | upper | sh.wc('-c'))()
+        size = os.path.getsize('README.rst')
+        cat, func, wc = output.stats
+        self.assertEqual((cat.read, func.read, wc.written),
+                         (size, size, size))
+
+    def test_trace(self):
+        import json
+        sh.trace.start('trace.jsonl')
+        try:
+            with sh.trace.span('deploy') as span:
+                (sh.cat('README.rst') | sh.grep('Chut'))()
+                list(sh.sh['sh'].map(['-c "echo 1"', '-c "echo 2"']))
+            sh.trace.stop()
+            with open('trace.jsonl') as fd:
+                events = [json.loads(line) for line in fd]
+        finally:
+            sh.trace.stop()
+            os.remove('trace.jsonl')
+        spans = dict((e['args']['id'], e) for e in events)
+        cats = sorted(e['cat'] for e in events)
+        self.assertEqual(cats, ['job', 'job', 'map', 'pipe',
+                                'stage', 'stage', 'user'])
+        for event in events:
+            parent = event['args']['parent']
+            if event['cat'] == 'user':
+                self.assertEqual(event['args']['id'], span)
+                self.assertIsNone(parent)
+            elif event['cat'] in ('pipe', 'map'):
+                self.assertEqual(parent, span)
+            else:
+                self.assertIn(spans[parent]['cat'], ('pipe', 'map'))
+                self.assertGreaterEqual(event['dur'], 0)
+        self.assertFalse(sh.trace.active)
+
+    def test_python_map(self):
+        def square(i):
+            return i * i // i
+
+        for backend in ('process', 'thread'):
+            results = list(sh.map(square, range(1, 100), backend=backend,
+                                  pool_size=4))
+            self.assertEqual(results, list(range(1, 100)))
+            results = list(sh.map(square, [1, 0, 2], backend=backend))
+            self.assertTrue(isinstance(results[1], ZeroDivisionError))
+            self.assertRaises(ZeroDivisionError, list,
+                              sh.map(square, [1, 0, 2], backend=backend,
+                                     stop_on_failure=True))
+
+        @sh.wraps
+        def upper(stdin):
+            for line in stdin:
+                yield line.upper()
+
+        results = list(sh.map(upper, ['a\nb', b'c']))
+        self.assertEqual(results, ['A\nB', 'C'])
+
     def test_call_opts(self):
         self.assertEqual(str(sh.ls('.')), str(sh.ls('.', shell=True)))
         self.assertEqual(str(sh.ls('.')), str(sh.ls('.')(shell=True)))
@@ -237,6 +805,16 @@ class Chut(unittest.TestCase):
         fab.run('safe-upgrade', '-h')
         fab.sudo('safe-upgrade', '-h')
 
+    def setUp(self):
+        # do not use the build cache of the user
+        self.cache_home = sh.env.get('XDG_CACHE_HOME')
+        sh.env['XDG_CACHE_HOME'] = os.path.abspath('tmp-cache')
+
     def tearDown(self):
         sh.rm('-f tmp')
         sh.rm('-f sudo')
+        sh.rm('-Rf tmp-cache')
+        if self.cache_home:
+            sh.env['XDG_CACHE_HOME'] = self.cache_home
+        else:
+            del sh.env['XDG_CACHE_HOME']